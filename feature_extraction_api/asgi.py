@@ -0,0 +1,157 @@
+"""
+ASGI serving mode for the single-wallet endpoint.
+
+Serves POST /extract-features, GET /lanes and GET /metrics with the same request and response
+contract as the Flask app in main.py, but runs extractions as asyncio tasks on one
+event loop instead of one thread per request: waits on Moralis, on the rate scheduler
+and on retry backoff hold no thread, so a process can keep hundreds of wallets in
+flight. Run it with uvicorn, e.g. `uvicorn asgi:app --port 8001`.
+"""
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import async_features
+import metrics
+from async_moralis_client import close_client, run_blocking
+from circuit_breaker import CircuitOpen
+from lanes import INTERACTIVE, SlotPool
+from rate_limiter import scheduler
+from service import cached_response, extraction_key, finish_response, parse_wallet_request, queued_budget
+
+# Extractions that may run at once on the event loop, across every lane
+ASYNC_EXTRACTION_SLOTS = int(os.environ.get("ASYNC_EXTRACTION_SLOTS", 256))
+
+async_extraction_slots = SlotPool(ASYNC_EXTRACTION_SLOTS)
+
+# Extractions in flight in this process, so concurrent requests for a wallet share one
+_inflight = {}
+
+
+async def compute_wallet(wallet_address, budget_limits, features=None, lane=INTERACTIVE):
+    """
+    Run the async feature pipeline for one wallet in the given priority lane, holding
+    an extraction slot while it runs. As in main.extraction_budget, time spent queued
+    for the slot counts against the request deadline.
+    """
+    queued_at = time.monotonic()
+    has_slot = await async_extraction_slots.acquire_async(lane, budget_limits[2])
+    try:
+        budget = queued_budget(budget_limits, lane, queued_at)
+        wallet_data = async_features.AsyncWalletData(wallet_address, budget)
+        try:
+            feature_values = await async_features.calculate_all_features(wallet_address, wallet_data, features)
+            return await run_blocking(finish_response, wallet_address, wallet_data, feature_values, features)
+        finally:
+            wallet_data.close()
+    finally:
+        if has_slot:
+            async_extraction_slots.release(lane)
+
+
+async def extract_wallet(wallet_address, budget_limits, refresh=False, features=None, lane=INTERACTIVE):
+    """
+    Async counterpart of main.extract_wallet. Requests for the same normalized address,
+    features and budget that arrive while an extraction is in flight in this process
+    await it and share its result.
+    """
+    cached = await run_blocking(cached_response, wallet_address, refresh, features)
+    if cached is not None:
+        return cached
+
+    key = extraction_key(wallet_address, budget_limits, features)
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.ensure_future(compute_wallet(wallet_address, budget_limits, features, lane))
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # A client that disconnects cancels only its own wait, not the shared extraction
+    result = await asyncio.shield(task)
+    return {**result, "walletAddress": wallet_address, "cached": False, "cacheAgeSeconds": 0}
+
+
+async def extract_features_endpoint(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    parsed, error = parse_wallet_request(data if isinstance(data, dict) else None, request.headers, INTERACTIVE)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    wallet_address, budget_limits, features, lane, refresh = parsed
+
+    try:
+        return JSONResponse(await extract_wallet(wallet_address, budget_limits, refresh, features, lane))
+    except CircuitOpen as e:
+        # Shed load while Moralis is degraded rather than queueing on it
+        retry_after = math.ceil(e.retry_after)
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": str(retry_after)})
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def lanes_endpoint(request):
+    return JSONResponse({"moralis": scheduler.stats(), "workers": async_extraction_slots.stats()})
+
+
+async def metrics_endpoint(request):
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware recording the requests in flight, their status codes and latency by route.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = scope["path"] if scope["path"] in ROUTES else "other"
+        status = []
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+            await send(message)
+
+        started = time.monotonic()
+        metrics.http_requests_in_flight.inc(route)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.http_requests_in_flight.dec(route)
+            metrics.http_request_seconds.observe(time.monotonic() - started, route)
+            metrics.http_requests.inc(route, str(status[0]) if status else "error")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await close_client()
+
+
+ROUTES = {
+    '/extract-features': (extract_features_endpoint, ['POST']),
+    '/lanes': (lanes_endpoint, ['GET']),
+    '/metrics': (metrics_endpoint, ['GET']),
+}
+
+app = Starlette(
+    routes=[Route(path, endpoint, methods=methods) for path, (endpoint, methods) in ROUTES.items()],
+    middleware=[
+        Middleware(RequestMetricsMiddleware),
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,184 @@
+"""
+Asyncio counterpart of the WalletData bundle, used by the ASGI serving mode.
+
+Sources are fetched through the async Moralis client as asyncio tasks instead of on a
+thread pool, and their pages are awaited without holding a thread. Once the sources a
+request needs are loaded, the feature groups are built by the same builders as the
+synchronous pipeline, so both serving modes return identical features.
+"""
+import asyncio
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+
+import history_sync
+from async_moralis_client import iter_items, run_blocking, run_walk
+from features_extraction import (
+    HISTORY_PARAMS, VERBOSE_TRANSACTIONS_PARAMS, TransactionFeatureEngine, WalletData, build_features,
+    defi_positions_walk, oldest_lending_interaction_walk, parse_block_timestamp, plan_fetches, resolve_features,
+    token_swap_count_walk, wallet_creation_date_walk, wallet_net_worth_walk,
+)
+
+_history_locks = {}
+
+
+@asynccontextmanager
+async def _history_lock(wallet):
+    """
+    Hold the wallet's sync lock. Locks are dropped once no sync holds or awaits them,
+    so there is no lock per wallet ever seen.
+    """
+    entry = _history_locks.setdefault(wallet, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _history_locks[wallet]
+
+
+async def sync_wallet_history(wallet_address, budget=None):
+    """
+    Async counterpart of history_sync.sync_wallet_history: run the same sync walk, with
+    its SQLite work on the blocking I/O threads, and return the stored history as a
+    stream, newest first. The stream reads SQLite, so it must be consumed with run_blocking.
+    """
+    async with _history_lock(wallet_address.lower()):
+        return await run_walk(history_sync.sync_walk(wallet_address, budget), wallet_address, budget, blocking=True)
+
+
+async def load_transaction_history(data):
+    """
+    Stream the wallet history through the bundle's engine, from the history store when enabled.
+    """
+    if history_sync.HISTORY_STORE_PATH:
+        try:
+            history = await sync_wallet_history(data.wallet_address, data.budget)
+        except sqlite3.Error as e:
+            print(f"Error using wallet history store, fetching full history: {e}")
+        else:
+            # The stored history of a large wallet is read and decoded row by row, off the
+            # loop. A store failure part-way through is not retried from Moralis, since the
+            # engine has already counted the rows read so far.
+            return await run_blocking(data.engine.consume_history, history)
+
+    async for tx in iter_items("wallet_history", data.wallet_address, HISTORY_PARAMS, data.budget):
+        data.engine.add_history_transaction(tx)
+    return data.engine
+
+
+async def load_verbose_transactions(data):
+    """
+    Stream the decoded transactions through the bundle's engine.
+    """
+    async for tx in iter_items("wallet_transactions_verbose", data.wallet_address, VERBOSE_TRANSACTIONS_PARAMS,
+                               data.budget):
+        data.engine.add_verbose_transaction(tx)
+    return data.engine
+
+
+async def resolve_creation_date(data):
+    """
+    Async counterpart of features_extraction.resolve_creation_date.
+    """
+    if data.loaded("transaction_history") and data.history_complete():
+        timestamp = data.transaction_history.oldest_history_timestamp
+        return parse_block_timestamp(timestamp) if timestamp else None
+    return await run_walk(wallet_creation_date_walk(data.budget), data.wallet_address, data.budget)
+
+
+# Async loaders of the datasets an AsyncWalletData bundle can hold, keyed like WALLET_DATA_SOURCES
+ASYNC_WALLET_DATA_SOURCES = {
+    "transaction_history": load_transaction_history,
+    "verbose_transactions": load_verbose_transactions,
+    "defi_positions": lambda data: run_walk(defi_positions_walk(data.budget), data.wallet_address, data.budget),
+    "creation_date": resolve_creation_date,
+    "net_worth": lambda data: run_walk(wallet_net_worth_walk(data.budget), data.wallet_address, data.budget),
+    "token_swap_count": lambda data: run_walk(token_swap_count_walk(data.budget), data.wallet_address, data.budget),
+    "oldest_lending_interaction": lambda data: run_walk(
+        oldest_lending_interaction_walk(data.budget), data.wallet_address, data.budget),
+}
+
+
+class AsyncWalletData(WalletData):
+    """
+    WalletData whose datasets are fetched by asyncio tasks on the running event loop.
+
+    Datasets must be awaited with load() before they are read; the synchronous
+    accessors inherited from WalletData (properties, history_complete,
+    incomplete_features, ...) then read the loaded values, so the feature builders of
+    the synchronous pipeline work on this bundle unchanged.
+    """
+
+    def __init__(self, wallet_address, budget):
+        self.wallet_address = wallet_address
+        self.budget = budget
+        self.engine = TransactionFeatureEngine()
+        self._tasks = {}
+
+    def _task(self, name):
+        task = self._tasks.get(name)
+        if task is None:
+            task = self._tasks[name] = asyncio.ensure_future(ASYNC_WALLET_DATA_SOURCES[name](self))
+        return task
+
+    def prefetch(self, *names):
+        for name in names:
+            self._task(name)
+
+    async def load(self, *names):
+        """
+        Fetch the given datasets concurrently, if they are not loaded yet, and wait for them.
+        """
+        await asyncio.gather(*(self._task(name) for name in names))
+
+    def get(self, name):
+        task = self._tasks.get(name)
+        if task is None or not task.done():
+            raise RuntimeError(f"{name} must be loaded before it is read")
+        return task.result()
+
+    def has(self, name):
+        return name in self._tasks
+
+    def loaded(self, name):
+        task = self._tasks.get(name)
+        return task is not None and task.done()
+
+    def close(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+
+async def calculate_all_features(wallet_address, data, features=None):
+    """
+    Async counterpart of features_extraction.calculate_all_features, fetching only the
+    sources the requested features depend on.
+
+    Args:
+        wallet_address (str): Wallet address to analyze.
+        data (AsyncWalletData): Data bundle to load the sources into.
+        features (list, optional): Feature and/or group names to compute. All features if omitted.
+
+    Returns:
+        dict: Feature name to value, for the requested features.
+    """
+    started = time.monotonic()
+    wanted = set(resolve_features(features))
+    initial_sources, position_sources = plan_fetches(wanted)
+    # The remaining sources are only used when the wallet holds DeFi positions, so they
+    # are started once that is known, while the initial ones are still being paged
+    data.prefetch(*initial_sources)
+    defi_positions = []
+    if "defi_positions" in initial_sources:
+        await data.load("defi_positions")
+        defi_positions = data.defi_positions
+    if defi_positions:
+        data.prefetch(*position_sources)
+    await data.load(*initial_sources, *(position_sources if defi_positions else ()))
+    # The first lending interaction is looked up on demand, as in the synchronous pipeline
+    if "DeFiEngagementDurationInDays" in wanted and data.creation_date and not data.has("verbose_transactions"):
+        await data.load("oldest_lending_interaction")
+    return build_features(data, defi_positions, wanted, started)
@@ -0,0 +1,200 @@
+"""
+Async client for the Moralis Web3 Data API, used by the ASGI serving mode.
+
+The asyncio counterpart of moralis_client: every request goes through one pooled
+httpx.AsyncClient, and rate-limit waits, retry backoff and pagination are awaited
+instead of holding a thread, so one process can keep hundreds of wallet extractions in
+flight. The call policy (budget admission, timeouts, breaker outcome, retries, page
+cache) and the walks of multi-call fetches are the ones of moralis_client; this module
+only awaits where the synchronous client blocks.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import httpx
+
+import page_cache
+from circuit_breaker import CircuitOpen
+from moralis_client import (
+    ENDPOINTS, MORALIS_BASE_URL, admit_call, cached_page, call_timeouts, encode_params, end_paging,
+    first_match_walk, recorded_call, refused_by_scheduler, retry_delay, scheduler_wait, stale_page, step_walk,
+)
+from rate_limiter import scheduler
+
+# Connections the async client keeps open to Moralis, and how many of them stay alive when idle
+MORALIS_ASYNC_MAX_CONNECTIONS = int(os.environ.get("MORALIS_ASYNC_MAX_CONNECTIONS", 100))
+MORALIS_ASYNC_MAX_KEEPALIVE = int(os.environ.get("MORALIS_ASYNC_MAX_KEEPALIVE", 32))
+# Threads running the blocking SQLite work of the async serving mode (page cache, history
+# store, shared result cache), so it never runs on the event loop
+ASYNC_BLOCKING_THREADS = int(os.environ.get("ASYNC_BLOCKING_THREADS", 16))
+
+_client = None
+_blocking_executor = ThreadPoolExecutor(max_workers=ASYNC_BLOCKING_THREADS)
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """
+    Run a blocking call on the blocking I/O threads and await its result.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_blocking_executor, partial(fn, *args, **kwargs))
+
+
+def get_client():
+    """
+    Return the process-wide async Moralis client, creating it on first use. It belongs
+    to the event loop that first used it; close_client() releases it on shutdown.
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            headers={
+                "Accept": "application/json",
+                "X-API-Key": os.environ.get("API_KEY", ""),
+            },
+            limits=httpx.Limits(
+                max_connections=MORALIS_ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=MORALIS_ASYNC_MAX_KEEPALIVE,
+            ),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def is_retryable(error):
+    """
+    Check whether a failed call is worth repeating: network errors, throttling and server errors.
+    """
+    if isinstance(error, (httpx.TimeoutException, httpx.NetworkError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+
+async def _fetch(endpoint, wallet_address, params, budget, count_page):
+    """
+    Make one Moralis call through the circuit breaker, rate scheduler and retry loop.
+    """
+    breaker, give_up_at = admit_call(endpoint, budget, count_page)
+    url = MORALIS_BASE_URL + ENDPOINTS[endpoint].format(address=wallet_address)
+    attempt = 0
+    while True:
+        try:
+            if await scheduler.acquire_async(endpoint, **scheduler_wait(budget)) is None:
+                raise refused_by_scheduler(endpoint, budget, count_page)
+            connect_timeout, read_timeout = call_timeouts(endpoint, budget)
+            with recorded_call(endpoint, breaker, httpx.HTTPError) as outcome:
+                response = await get_client().get(
+                    url,
+                    params=encode_params(params),
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                )
+                outcome.responded(response)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as e:
+            delay = retry_delay(endpoint, attempt, e, is_retryable(e), give_up_at)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def moralis_get(endpoint, wallet_address, params=None, use_cache=True, budget=None, count_page=True):
+    """
+    Call a Moralis endpoint for a wallet through the shared async client.
+
+    Behaves like moralis_client.moralis_get: fresh responses in the page cache are
+    returned without a network call, and while the endpoint's circuit breaker is open an
+    expired cached response is returned if there is one, otherwise CircuitOpen is raised.
+
+    Raises:
+        BudgetExhausted: The budget ran out or the request deadline passed before the call.
+        CircuitOpen: The endpoint's circuit breaker is open and nothing is cached.
+        httpx.HTTPError: The call failed and could not be retried.
+    """
+    if use_cache:
+        cached = await run_blocking(cached_page, endpoint, wallet_address, params)
+        if cached is not None:
+            return cached
+
+    try:
+        body = await _fetch(endpoint, wallet_address, params, budget, count_page)
+    except CircuitOpen:
+        stale = await run_blocking(stale_page, endpoint, wallet_address, params, budget, use_cache)
+        if stale is None:
+            raise
+        return stale
+    if use_cache:
+        await run_blocking(page_cache.put, endpoint, wallet_address, params, body)
+    return body
+
+
+async def run_walk(walk, wallet_address, budget=None, blocking=False):
+    """
+    Async counterpart of moralis_client.run_walk. Walks that use SQLite between calls
+    (the history sync) pass blocking, so they are stepped on the blocking I/O threads.
+    """
+    async def step(*args, **kwargs):
+        if blocking:
+            return await run_blocking(step_walk, walk, *args, **kwargs)
+        return step_walk(walk, *args, **kwargs)
+
+    done, value = await step()
+    while not done:
+        endpoint, params, count_page = value
+        try:
+            result = await moralis_get(endpoint, wallet_address, params, budget=budget, count_page=count_page)
+        except Exception as e:
+            done, value = await step(error=e)
+        else:
+            done, value = await step(result)
+    return value
+
+
+async def iter_pages(endpoint, wallet_address, params=None, budget=None):
+    """
+    Yield the result list of each page of a paginated Moralis endpoint, following cursors.
+
+    Pages are fetched lazily and errors end the iteration exactly as in
+    moralis_client.iter_pages.
+    """
+    params = dict(params or {})
+    while True:
+        try:
+            result = await moralis_get(endpoint, wallet_address, params, budget=budget)
+        except Exception as e:
+            end_paging(endpoint, params, budget, e)
+            return
+
+        yield result.get("result", [])
+
+        cursor = result.get("cursor")
+        if not cursor:
+            return
+        params["cursor"] = cursor
+
+
+async def iter_items(endpoint, wallet_address, params=None, budget=None):
+    """
+    Yield the individual items of a paginated Moralis endpoint, one page at a time.
+    """
+    async for page in iter_pages(endpoint, wallet_address, params, budget):
+        for item in page:
+            yield item
+
+
+async def find_first(endpoint, wallet_address, params, predicate, budget=None):
+    """
+    Return the first item matching predicate, stopping pagination as soon as it is found.
+    """
+    return await run_walk(first_match_walk(endpoint, params, predicate, budget), wallet_address, budget)
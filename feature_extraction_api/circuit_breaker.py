@@ -0,0 +1,146 @@
+"""
+Per-endpoint circuit breakers for Moralis calls.
+
+Each endpoint keeps a window of its most recent call outcomes. When the error rate over
+the window crosses the threshold the breaker opens and calls to that endpoint fail
+immediately with CircuitOpen instead of waiting on a degraded service. After a cool-down
+one probe call is let through (half-open): if it succeeds the breaker closes, otherwise
+it opens again.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+# Error rate over the last CIRCUIT_BREAKER_WINDOW calls that opens a breaker, once at
+# least CIRCUIT_BREAKER_MIN_CALLS outcomes are recorded
+CIRCUIT_BREAKER_ERROR_RATE = float(os.environ.get("CIRCUIT_BREAKER_ERROR_RATE", 0.5))
+CIRCUIT_BREAKER_WINDOW = int(os.environ.get("CIRCUIT_BREAKER_WINDOW", 20))
+CIRCUIT_BREAKER_MIN_CALLS = int(os.environ.get("CIRCUIT_BREAKER_MIN_CALLS", 10))
+# Seconds an open breaker rejects calls before letting a probe through
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_OPEN_SECONDS", 30))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an endpoint whose breaker is open."""
+
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"Moralis {endpoint} is unavailable, retry in {retry_after:.0f}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Error-rate circuit breaker with half-open probing.
+    """
+
+    def __init__(self, endpoint, error_rate=CIRCUIT_BREAKER_ERROR_RATE, window=CIRCUIT_BREAKER_WINDOW,
+                 min_calls=CIRCUIT_BREAKER_MIN_CALLS, open_seconds=CIRCUIT_BREAKER_OPEN_SECONDS):
+        self.endpoint = endpoint
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.outcomes = deque(maxlen=window)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        """
+        Seconds until an open breaker lets a probe through, or 0 if it accepts calls.
+        """
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    def check(self):
+        """
+        Raise CircuitOpen if a call would be rejected right now, without admitting one.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self.opened_at + self.open_seconds - time.monotonic()
+                if remaining > 0:
+                    raise CircuitOpen(self.endpoint, remaining)
+            elif self.state == HALF_OPEN and self._probing:
+                raise CircuitOpen(self.endpoint, self.open_seconds)
+
+    def before_call(self):
+        """
+        Admit a call, or raise CircuitOpen. In the half-open state only one probe is
+        admitted at a time. Every admitted call must end in record() or release().
+        """
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self.opened_at + self.open_seconds - time.monotonic()
+                if remaining > 0:
+                    raise CircuitOpen(self.endpoint, remaining)
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    raise CircuitOpen(self.endpoint, self.open_seconds)
+                self._probing = True
+
+    def release(self):
+        """
+        Give back an admitted call that ended without an outcome (e.g. it was cancelled),
+        so a half-open breaker lets the next call probe.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+
+    def record(self, success):
+        with self._lock:
+            if self.state == OPEN:
+                return  # a call admitted before the breaker opened
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if success:
+                    self.state = CLOSED
+                    self.outcomes.clear()
+                else:
+                    self._open()
+                return
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.error_rate:
+                self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        print(f"Circuit breaker for Moralis {self.endpoint} opened for {self.open_seconds:.0f}s")
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint):
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = _breakers[endpoint] = CircuitBreaker(endpoint)
+        return breaker
+
+
+def raise_if_open(endpoints=None):
+    """
+    Raise CircuitOpen for the open breaker with the longest wait, if any of the given
+    endpoints (every endpoint if omitted) is rejecting calls.
+    """
+    with _breakers_lock:
+        breakers = [breaker for endpoint, breaker in _breakers.items() if endpoints is None or endpoint in endpoints]
+    waits = [(breaker.retry_after(), breaker.endpoint) for breaker in breakers]
+    retry_after, endpoint = max(waits, default=(0.0, None))
+    if retry_after:
+        raise CircuitOpen(endpoint, retry_after)
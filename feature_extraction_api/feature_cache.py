@@ -0,0 +1,147 @@
+"""
+TTL + LRU cache of computed feature results.
+
+Results are kept in an in-process LRU bounded by total serialized size, and can also be
+written to a shared SQLite backend so every gunicorn worker on the host reuses them.
+Entries older than the TTL are never returned as fresh, but are kept for up to the stale
+TTL so they can be served, marked stale, while Moralis is unavailable. Wallets confirmed
+to have no history are kept in a separate negative cache with a longer TTL of their own.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds a computed feature result is served from cache
+FEATURE_CACHE_TTL = int(os.environ.get("FEATURE_CACHE_TTL", 600))
+# Upper bound on the serialized size of the results kept in each process
+FEATURE_CACHE_MAX_BYTES = int(os.environ.get("FEATURE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# Seconds an expired result is kept to be served as stale while Moralis is unavailable
+FEATURE_CACHE_STALE_TTL = int(os.environ.get("FEATURE_CACHE_STALE_TTL", 86400))
+# Seconds a wallet confirmed to have no history keeps its empty result, and the memory
+# bound for those results
+EMPTY_WALLET_CACHE_TTL = int(os.environ.get("EMPTY_WALLET_CACHE_TTL", 86400))
+EMPTY_WALLET_CACHE_MAX_BYTES = int(os.environ.get("EMPTY_WALLET_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+# Optional SQLite file shared by worker processes; empty keeps the cache in-process only
+FEATURE_CACHE_SHARED_PATH = os.environ.get("FEATURE_CACHE_SHARED_PATH", "")
+
+
+class ResultCache:
+    """
+    Thread-safe LRU of JSON-serializable results with a TTL, a memory bound and an
+    optional shared SQLite backend.
+    """
+
+    def __init__(self, ttl, max_bytes, shared_path="", namespace="features", stale_ttl=0):
+        self.ttl = ttl
+        self.retention = max(ttl, stale_ttl)
+        self.max_bytes = max_bytes
+        self.shared_path = shared_path
+        self.namespace = namespace
+        self._entries = OrderedDict()  # key -> (value, stored_at, size)
+        self._size = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.shared_path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.shared_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS results (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+            self._local.connection = connection
+        return connection
+
+    def _store_local(self, key, value, stored_at, size):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[2]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, stored_at, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def get(self, key, max_age=None, prefer_shared=False):
+        """
+        Return (value, age_seconds) for a cached result no older than max_age
+        (the TTL by default), or None. With prefer_shared, the shared backend (when
+        configured) is read first, for entries other processes may have updated.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        now = time.time()
+        with self._lock:
+            entry = None if prefer_shared and self.shared_path else self._entries.get(key)
+            if entry is not None:
+                value, stored_at, _ = entry
+                if now - stored_at <= max_age:
+                    self._entries.move_to_end(key)
+                    return value, now - stored_at
+
+        if not self.shared_path:
+            return None
+        try:
+            row = self._connection().execute(
+                "SELECT body, stored_at FROM results WHERE namespace = ? AND key = ?", (self.namespace, key)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading shared result cache: {e}")
+            return None
+        if row is None or now - row[1] > max_age:
+            return None
+        value = json.loads(row[0])
+        self._store_local(key, value, row[1], len(row[0]))
+        return value, now - row[1]
+
+    def put(self, key, value):
+        body = json.dumps(value)
+        stored_at = time.time()
+        self._store_local(key, value, stored_at, len(body))
+        if not self.shared_path:
+            return
+        try:
+            connection = self._connection()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (self.namespace, key, body, stored_at)
+                )
+                connection.execute(
+                    "DELETE FROM results WHERE namespace = ? AND stored_at < ?",
+                    (self.namespace, stored_at - self.retention),
+                )
+        except sqlite3.Error as e:
+            print(f"Error writing shared result cache: {e}")
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[2]
+        if self.shared_path:
+            connection = self._connection()
+            with connection:
+                connection.execute("DELETE FROM results WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+
+feature_cache = ResultCache(
+    FEATURE_CACHE_TTL, FEATURE_CACHE_MAX_BYTES, FEATURE_CACHE_SHARED_PATH, stale_ttl=FEATURE_CACHE_STALE_TTL
+)
+empty_wallet_cache = ResultCache(
+    EMPTY_WALLET_CACHE_TTL, EMPTY_WALLET_CACHE_MAX_BYTES, FEATURE_CACHE_SHARED_PATH, namespace="empty"
+)
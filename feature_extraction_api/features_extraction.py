@@ -1,8 +1,16 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
-import requests
 import os
+import sqlite3
+import threading
+import time
 from dotenv import load_dotenv
-from moralis import evm_api
+import metrics
+from lanes import EXTRACTION_SLOTS
+from moralis_client import FetchBudget, first_match_walk, iter_items, paged_walk, run_walk, single_call_walk
+from method_classifier import classify_decoded_call
+import history_sync
 
 # Load environment variables from .env file
 load_dotenv()
@@ -12,161 +20,206 @@ API_KEY = os.environ.get("API_KEY")
 if not API_KEY:
     raise Exception("API_KEY not found. Please set it in your .env file.")
 
-# Wallet methods indicating repayments, liquidate and other interactions
-WALLET_METHODS_REPAY = [
-    # General Repayment Methods
-    "repay", "repayborrow", "repayWithPermit", "repayBorrowBehalf",
-    "paybackDebt", "burnSynths", "repayDebt", "repayLoan", "repayTroves",
+# Maximum number of Moralis datasets fetched concurrently for a single wallet
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", 5))
+# Threads fetching Moralis datasets for every wallet in the process
+FETCH_THREADS = int(os.environ.get("FETCH_THREADS", FETCH_CONCURRENCY * EXTRACTION_SLOTS))
+
+# Default per-wallet fetch budget: pages of paginated Moralis listings fetched from the network,
+# and seconds spent paging. Unset means unbounded. Once exhausted, paging stops and features
+# are computed from the data fetched so far; single-call sources are not limited.
+FEATURE_MAX_PAGES = int(os.environ["FEATURE_MAX_PAGES"]) if os.environ.get("FEATURE_MAX_PAGES") else None
+FEATURE_MAX_SECONDS = float(os.environ["FEATURE_MAX_SECONDS"]) if os.environ.get("FEATURE_MAX_SECONDS") else None
+
+# Features derived from each Moralis source, used to flag features computed from incomplete
+# data. The creation date lookup is tracked apart from the paginated wallet_history stream.
+ENDPOINT_FEATURES = {
+    "wallet_history": ["TransactionFrequency", "TransactionVolume", "LargestTransaction", "AverageTransactionValue"],
+    "wallet_transactions_verbose": ["LiquidationEventCount", "RepaymentActivityProxy", "DeFiEngagementDurationInDays"],
+    "wallet_swaps": ["TokenSwapCount"],
+    "wallet_creation_date": ["TransactionFrequency", "TransactionVolume", "LargestTransaction",
+                             "AverageTransactionValue", "WalletAgeInDays", "DeFiEngagementDurationInDays"],
+    "defi_positions_summary": ["LiquidationEventCount", "AverageHealthFactor", "AverageAPY", "CollateralUtilization",
+                               "TotalOutstandingDebt", "AverageDebtSize", "DebtToAssetRatio", "RepaymentActivityProxy",
+                               "EarningsEfficiency", "ProtocolDiversity", "LendingProtocolCount",
+                               "LiquidityProvisionCount", "TokenSwapCount"],
+    "wallet_net_worth": ["DebtToAssetRatio"],
+}
+
+# Features in output order, by feature group. Callers may request a group by name.
+FEATURE_GROUPS = {
+    "TransactionHistory": ["TransactionFrequency", "TransactionVolume", "LargestTransaction",
+                           "AverageTransactionValue"],
+    "LiquidationHistory": ["LiquidationEventCount", "AverageHealthFactor", "AverageAPY", "CollateralUtilization"],
+    "DebtAndRepayments": ["TotalOutstandingDebt", "AverageDebtSize", "DebtToAssetRatio", "RepaymentActivityProxy",
+                          "EarningsEfficiency"],
+    "CreditMix": ["ProtocolDiversity", "LendingProtocolCount", "LiquidityProvisionCount", "TokenSwapCount"],
+    "LengthOfCreditHistory": ["WalletAgeInDays", "DeFiEngagementDurationInDays"],
+}
+ALL_FEATURES = [feature for group in FEATURE_GROUPS.values() for feature in group]
+
+# WalletData sources each feature is computed from. The sources in POSITION_SOURCES are
+# only read when the wallet holds DeFi positions.
+_POSITIONS = ("defi_positions",)
+FEATURE_SOURCES = {
+    **{feature: ("transaction_history", "creation_date") for feature in FEATURE_GROUPS["TransactionHistory"]},
+    **{feature: _POSITIONS for feature in FEATURE_GROUPS["LiquidationHistory"] + FEATURE_GROUPS["DebtAndRepayments"]
+       + FEATURE_GROUPS["CreditMix"]},
+    "LiquidationEventCount": _POSITIONS + ("verbose_transactions",),
+    "RepaymentActivityProxy": _POSITIONS + ("verbose_transactions",),
+    "DebtToAssetRatio": _POSITIONS + ("net_worth",),
+    "TokenSwapCount": _POSITIONS + ("token_swap_count",),
+    "WalletAgeInDays": ("creation_date",),
+    # The first lending interaction is looked up on demand, once the creation date is known
+    "DeFiEngagementDurationInDays": ("creation_date",),
+}
+INITIAL_SOURCES = ("transaction_history", "defi_positions", "creation_date")
+POSITION_SOURCES = ("verbose_transactions", "net_worth", "token_swap_count")
+
+# Moralis endpoint each WalletData source calls
+SOURCE_ENDPOINTS = {
+    "transaction_history": "wallet_history",
+    "verbose_transactions": "wallet_transactions_verbose",
+    "defi_positions": "defi_positions_summary",
+    "creation_date": "wallet_history",
+    "net_worth": "wallet_net_worth",
+    "token_swap_count": "wallet_swaps",
+    "oldest_lending_interaction": "wallet_transactions_verbose",
+}
+
+
+def resolve_features(requested=None):
+    """
+    Expand a list of feature and group names into feature names, in output order.
+
+    Raises:
+        ValueError: If a name is neither a feature nor a group.
+    """
+    if requested is None:
+        return list(ALL_FEATURES)
+    names = set()
+    unknown = []
+    for name in requested:
+        if name in FEATURE_GROUPS:
+            names.update(FEATURE_GROUPS[name])
+        elif name in FEATURE_SOURCES:
+            names.add(name)
+        else:
+            unknown.append(name)
+    if unknown:
+        raise ValueError(f"Unknown features: {', '.join(map(str, unknown))}")
+    return [feature for feature in ALL_FEATURES if feature in names]
+
+
+def plan_fetches(features):
+    """
+    Work out the minimal set of WalletData sources for the given features.
 
-    # Specific Protocols
-    "repayStableDebt", "repayVariableDebt",  # Aave
-    "repayFor",  # Some custom implementations
-    "repayCollateralizedDebt",  # Compound-like protocols
-]
-
-WALLET_METHODS_LIQUIDATE = [
-    # General Liquidation Methods
-    "liquidationCall", "liquidateBorrow", "liquidate",
-    "liquidateDelinquentAccount", "liquidateTroves", "liquidatePosition",
-
-    # Specific to MakerDAO
-    "bite",
-
-    # Liquity
-    "redeemCollateral", "adjustTrove", "closeTrove",
-
-    # Venus Protocol
-    "seize",
-
-    # Alpha Homora
-    "forceClosePosition",
-
-    # SushiSwap/Kashi
-    "liquidateAccount",
-]
-
-WALLET_METHODS_HISTORY = [
-    "deposit", "supply", "withdraw", "borrow", "repay", "repayborrow", "flashLoan", "flash",
-    "swapBorrowRateMode", "setUserUseReserveAsCollateral", "configureReserveAsCollateral",
-    "setCollateralConfiguration", "approveDelegation", "delegateCredit", "lockCollateral",
-    "freeCollateral", "enterMarkets", "exitMarket", "mint", "redeem", "redeemUnderlying",
-    "increaseAllowance", "repayWithPermit", "liquidationCall", "liquidateBorrow", "liquidate",
-    "repayBorrowBehalf", "generateDebt", "paybackDebt", "swap", "swapExactTokensForTokens",
-    "flashMint", "collateralSwap", "addLiquidity", "removeLiquidity"
-]
+    Returns:
+        tuple: (sources to fetch up front, sources to fetch only if the wallet holds DeFi positions).
+    """
+    sources = {source for feature in features for source in FEATURE_SOURCES[feature]}
+    return (
+        [source for source in INITIAL_SOURCES if source in sources],
+        [source for source in POSITION_SOURCES if source in sources],
+    )
+
+
+def required_endpoints(features):
+    """
+    Return the Moralis endpoints the given features need whatever the wallet holds: those
+    of the sources fetched up front. The other sources depend on the wallet's DeFi
+    positions and degrade to failed features when their endpoint is unavailable.
+    """
+    initial_sources, _ = plan_fetches(features)
+    return {SOURCE_ENDPOINTS[source] for source in initial_sources}
+
+
+# Query parameters of the Moralis requests made for each source, shared by the
+# synchronous pipeline and the async one in async_features.py
+NET_WORTH_PARAMS = {
+    "chains": ["eth"],
+    "exclude_spam": True,
+    "exclude_unverified_contracts": True,
+}
+VERBOSE_TRANSACTIONS_PARAMS = {"chain": "eth", "limit": 100}
+HISTORY_PARAMS = history_sync.HISTORY_PARAMS
+DEFI_POSITIONS_PARAMS = {"chain": "eth"}
+SWAPS_PARAMS = {"chain": "eth", "order": "DESC", "limit": 100}
+FIRST_TRANSACTION_PARAMS = {
+    "chain": "eth",
+    "order": "ASC",  # Oldest transaction first
+    "limit": 1
+}
+OLDEST_VERBOSE_TRANSACTIONS_PARAMS = {
+    "chain": "eth",
+    "limit": 100,
+    "order": "ASC"
+}
 
 
 # initial unctions to fetch transactions list, Defi Position List, and Wallet information using Moralis API for
-# further processing
-def fetch_wallet_net_worth(wallet_address):
+# further processing. All calls go through the pooled client in moralis_client.py. The
+# *_walk functions hold the logic of each fetch and are run by async_features.py as well
+def wallet_net_worth_walk(budget=None):
     """
-    Fetch the wallet's total net worth.
+    Walk fetching the wallet's total net worth.
     """
-    params = {
-        "chains": ["eth"],
-        "exclude_spam": True,
-        "exclude_unverified_contracts": True,
-        "address": wallet_address,
-    }
-    try:
-        result = evm_api.wallets.get_wallet_net_worth(api_key=API_KEY, params=params)
-        return float(result.get("total_networth_usd", 0))
-    except Exception as e:
-        print(f"Error fetching wallet net worth: {e}")
-        return 0.0
+    return single_call_walk(
+        "wallet_net_worth", NET_WORTH_PARAMS, lambda result: float(result.get("total_networth_usd", 0)), 0.0,
+        "wallet_net_worth", budget,
+    )
 
-def fetch_wallet_transactions(wallet_address):
+def fetch_wallet_net_worth(wallet_address, budget=None):
     """
-    Fetch all wallet transactions using the Moralis API.
+    Fetch the wallet's total net worth. The call observes the budget's request deadline,
+    if given, and a failure is recorded on it.
     """
-    params = {"chain": "eth", "address": wallet_address, "limit": 100}
-    transactions = []
-    cursor = None
+    return run_walk(wallet_net_worth_walk(budget), wallet_address, budget)
 
-    while True:
-        if cursor:
-            params["cursor"] = cursor
-        try:
-            result = evm_api.transaction.get_wallet_transactions_verbose(api_key=API_KEY, params=params)
-            transactions.extend(result.get("result", []))
-            cursor = result.get("cursor")
-            if not cursor:
-                break
-        except Exception as e:
-            print(f"Error fetching transactions: {e}")
-            break
-
-    return transactions
+def iter_wallet_transactions(wallet_address, budget=None):
+    """
+    Stream all verbose (decoded) wallet transactions using the Moralis API, one page at a time.
+    """
+    return iter_items("wallet_transactions_verbose", wallet_address, VERBOSE_TRANSACTIONS_PARAMS, budget)
 
-def fetch_transaction_data(wallet_address):
+def iter_transaction_data(wallet_address, budget=None):
     """
-    Fetch transaction data for a wallet using Moralis API with pagination.
+    Stream transaction data for a wallet using Moralis API with pagination, newest first.
+
+    When the local history store is enabled, only activity newer than the last sync is
+    fetched and the stored history is streamed back from disk.
 
     Args:
         wallet_address (str): Wallet address to retrieve transactions for.
 
     Returns:
-        list: List of all transactions from the API response.
+        iterator: All transactions, newest first.
     """
-    params = {
-        "chain": "eth",
-        "order": "DESC",
-        "address": wallet_address,
-        "limit": 100,
-    }
-
-    transactions = []
-    cursor = None
-
-    while True:
-        if cursor:
-            params["cursor"] = cursor
-
+    if history_sync.HISTORY_STORE_PATH:
         try:
-            result = evm_api.wallets.get_wallet_history(api_key=API_KEY, params=params)
-            transactions.extend(result.get("result", []))
-            cursor = result.get("cursor")
-
-            # Break if no more pages
-            if not cursor:
-                break
-
-        except Exception as e:
-            print(f"Error fetching transaction data: {e}")
-            break
+            return history_sync.sync_wallet_history(wallet_address, budget)
+        except sqlite3.Error as e:
+            print(f"Error using wallet history store, fetching full history: {e}")
 
-    return transactions
+    return iter_items("wallet_history", wallet_address, HISTORY_PARAMS, budget)
 
-def fetch_defi_positions(wallet_address):
+def defi_positions_walk(budget=None):
     """
-    Fetch DeFi positions for a wallet to analyze borrowing and collateral.
+    Walk fetching the wallet's DeFi positions.
     """
-    params = {"chain": "eth", "address": wallet_address}
-    try:
-        result = evm_api.wallets.get_defi_positions_summary(api_key=API_KEY, params=params)
-        return result if isinstance(result, list) else []
-    except Exception as e:
-        print(f"Error fetching DeFi positions: {e}")
-        return []
-
+    return single_call_walk(
+        "defi_positions_summary", DEFI_POSITIONS_PARAMS, lambda result: result if isinstance(result, list) else [],
+        [], "defi_positions_summary", budget,
+    )
 
-# functions used to engineer liquidation history features
-def calculate_liquidation_event_count(wallet_address):
+def fetch_defi_positions(wallet_address, budget=None):
     """
-    Calculate the total number of liquidation events based on transaction data
-    using the WALLET_METHODS_LIQUIDATE list.
+    Fetch DeFi positions for a wallet to analyze borrowing and collateral. The call
+    observes the budget's request deadline, if given, and a failure is recorded on it.
     """
-    transactions = fetch_wallet_transactions(wallet_address)
-    liquidation_count = 0
+    return run_walk(defi_positions_walk(budget), wallet_address, budget)
 
-    for tx in transactions:
-        decoded_call = tx.get("decoded_call", {})  # Extract the decoded call details
-        if isinstance(decoded_call, dict):  # Ensure it's a dictionary
-            method = decoded_call.get("label", "").lower()
-            if any(liquidation_method in method for liquidation_method in WALLET_METHODS_LIQUIDATE):
-                liquidation_count += 1
-
-    return liquidation_count
 
 def calculate_average_health_and_apy(positions):
     """
@@ -245,20 +298,6 @@ def calculate_total_outstanding_debt(positions):
             total_outstanding_debt += balance_usd
     return round(total_outstanding_debt, 2)
 
-def calculate_repayment_activity_proxy(wallet_address):
-    """
-    Calculate the total number of repayment transactions.
-    """
-    transactions = fetch_wallet_transactions(wallet_address)
-    repayment_count = 0
-    for tx in transactions:
-        decoded_call = tx.get("decoded_call")  # No default here
-        if isinstance(decoded_call, dict):  # Ensure decoded_call is a dictionary
-            method = decoded_call.get("label", "").lower()
-            if any(method in wm for wm in WALLET_METHODS_REPAY):
-                repayment_count += 1
-    return repayment_count
-
 def calculate_earnings_efficiency(positions):
     """
     Calculate Earnings Efficiency as the ratio of projected yearly profit to total collateral supplied.
@@ -360,7 +399,20 @@ def calculate_liquidity_provision_count(defi_positions):
     return liquidity_positions_count
 
 
-def calculate_token_swap_count(wallet_address):
+def token_swap_count_walk(budget=None):
+    """
+    Walk counting the wallet's swap events with transactionType 'buy' or 'sell'.
+    """
+    swap_count = 0
+
+    def count(page):
+        nonlocal swap_count
+        swap_count += sum(1 for swap in page if is_token_swap(swap))
+
+    yield from paged_walk("wallet_swaps", SWAPS_PARAMS, count, budget)
+    return swap_count
+
+def calculate_token_swap_count(wallet_address, budget=None):
     """
     Calculate the number of token swaps conducted (buy or sell) using Moralis API.
 
@@ -370,220 +422,560 @@ def calculate_token_swap_count(wallet_address):
     Returns:
         int: Count of swap events with transactionType 'buy' or 'sell'.
     """
-    url = f"https://deep-index.moralis.io/api/v2.2/wallets/{wallet_address}/swaps"
-    params = {"chain": "eth", "order": "DESC", "limit": 100}
-    headers = {
-        "Accept": "application/json",
-        "X-API-Key": API_KEY
-    }
-    swap_count = 0
-    cursor = None
+    return run_walk(token_swap_count_walk(budget), wallet_address, budget)
 
-    while True:
-        if cursor:
-            params["cursor"] = cursor
+def is_token_swap(swap):
+    """
+    Check whether a swap event is a buy or a sell.
+    """
+    transaction_type = swap.get("transactionType", "").lower()
+    return transaction_type in ["buy", "sell"]
 
-        try:
-            # API call using requests
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status()
-            result = response.json()
-
-            swaps = result.get("result", [])
-            for swap in swaps:
-                transaction_type = swap.get("transactionType", "").lower()
-                if transaction_type in ["buy", "sell"]:
-                    swap_count += 1
-
-            cursor = result.get("cursor")
-            if not cursor:
-                break  # Exit loop if no more data
-        except Exception as e:
-            print(f"Error fetching swaps: {e}")
-            break
+# functions used to engineer length of credit History
+def wallet_creation_date_walk(budget=None):
+    """
+    Walk fetching the timestamp of the wallet's first transaction.
+    """
+    return single_call_walk(
+        "wallet_history", FIRST_TRANSACTION_PARAMS, parse_first_transaction_date, None, "wallet_creation_date", budget
+    )
 
-    return swap_count
+def fetch_wallet_creation_date(wallet_address, budget=None):
+    """
+    Get the wallet's first transaction date to determine wallet creation date. The call
+    observes the budget's request deadline, if given, and a failure is recorded on it.
+    """
+    return run_walk(wallet_creation_date_walk(budget), wallet_address, budget)
 
-# functions used to engineer length of credit History
-def fetch_wallet_creation_date(wallet_address):
+def parse_first_transaction_date(result):
     """
-    Get the wallet's first transaction date to determine wallet creation date.
+    Return the timestamp of the single transaction in an oldest-first wallet_history
+    page, or None if the wallet has no history.
     """
-    params = {
-        "chain": "eth",
-        "order": "ASC",  # Oldest transaction first
-        "address": wallet_address,
-        "limit": 1
-    }
-    try:
-        result = evm_api.wallets.get_wallet_history(api_key=API_KEY, params=params)
-        first_tx = result.get("result", [])
-        if first_tx:
-            timestamp = first_tx[0]["block_timestamp"]
-            return datetime.fromisoformat(timestamp.replace("Z", "")).replace(tzinfo=timezone.utc)
-    except Exception as e:
-        print(f"Error fetching wallet creation date: {e}")
+    first_tx = result.get("result", [])
+    if first_tx:
+        return parse_block_timestamp(first_tx[0]["block_timestamp"])
     return None
 
-def calculate_defi_engagement_duration(wallet_address):
+def parse_block_timestamp(timestamp):
+    return datetime.fromisoformat(timestamp.replace("Z", "")).replace(tzinfo=timezone.utc)
+
+def calculate_defi_engagement_duration(first_interaction):
     """
     Calculate the total engagement duration with DeFi protocols.
+
+    Args:
+        first_interaction (datetime): Timestamp of the first lending/borrowing protocol interaction.
+
+    Returns:
+        int: Days since the first interaction, or 0 if there was none.
     """
-    first_interaction = fetch_oldest_lending_interaction(wallet_address)
     if first_interaction:
         today = datetime.now(timezone.utc)
         duration = (today - first_interaction).days
         return duration
     return 0
 
-def fetch_oldest_lending_interaction(wallet_address):
+def is_lending_interaction(tx):
     """
-    Find the timestamp of the first lending/borrowing protocol interaction.
+    Check whether a verbose transaction calls one of the WALLET_METHODS_HISTORY methods.
     """
-    params = {
-        "chain": "eth",
-        "address": wallet_address,
-        "limit": 100,
-        "order": "ASC"
-    }
-
-    transactions = []
-    cursor = None
+    return classify_decoded_call(tx.get("decoded_call")).history
 
-    while True:
-        if cursor:
-            params["cursor"] = cursor
-        try:
-            result = evm_api.transaction.get_wallet_transactions_verbose(api_key=API_KEY, params=params)
-            transactions.extend(result.get("result", []))
-            cursor = result.get("cursor")
-            if not cursor:
-                break
-        except Exception as e:
-            print(f"Error fetching transactions: {e}")
-            break
-
-    for tx in transactions:
-        decoded_call = tx.get("decoded_call", {})
-        if decoded_call:
-            method = decoded_call.get("label", "").lower()
-            if method in WALLET_METHODS_HISTORY:
-                return datetime.fromisoformat(tx["block_timestamp"].replace("Z", "")).replace(tzinfo=timezone.utc)
+def oldest_lending_interaction_walk(budget=None):
+    """
+    Walk finding the timestamp of the first lending/borrowing protocol interaction.
+    """
+    tx = yield from first_match_walk(
+        "wallet_transactions_verbose", OLDEST_VERBOSE_TRANSACTIONS_PARAMS, is_lending_interaction, budget
+    )
+    if tx:
+        return parse_block_timestamp(tx["block_timestamp"])
     return None
 
+def fetch_oldest_lending_interaction(wallet_address, budget=None):
+    """
+    Find the timestamp of the first lending/borrowing protocol interaction.
 
-def calculate_all_features(wallet_address):
-    # Fetch shared data
-    transactions = fetch_transaction_data(wallet_address)
-    defi_positions = fetch_defi_positions(wallet_address)
-    creation_date = fetch_wallet_creation_date(wallet_address)
-
-    # Transaction History
-    if transactions and creation_date:
+    The verbose history is streamed oldest first and pagination stops at the first
+    match, so long-lived wallets only cost the pages up to their first DeFi call.
+    """
+    return run_walk(oldest_lending_interaction_walk(budget), wallet_address, budget)
+
+class TransactionFeatureEngine:
+    """
+    Single-pass accumulator for every transaction-derived feature.
+
+    Wallet history entries feed TransactionFrequency, TransactionVolume, LargestTransaction
+    and AverageTransactionValue; decoded (verbose) transactions feed LiquidationEventCount,
+    RepaymentActivityProxy and the first DeFi interaction. Each transaction is visited
+    once, its value converted once and its decoded call classified once, updating every
+    accumulator it contributes to.
+    """
+
+    def __init__(self):
+        self.transaction_count = 0
+        self.transaction_volume = 0
+        self.largest_transaction = 0
+        self.liquidation_count = 0
+        self.repayment_count = 0
+        self.oldest_lending_interaction = None
+        self.oldest_history_timestamp = None
+
+    def add_history_transaction(self, tx):
+        # The history is streamed newest first, so the last entry seen is the oldest
+        self.oldest_history_timestamp = tx.get("block_timestamp")
+        value = int(tx.get("value", 0)) / 10**18  # Convert from Wei to ETH
+        self.transaction_volume += value
+        if self.transaction_count == 0 or value > self.largest_transaction:
+            self.largest_transaction = value
+        self.transaction_count += 1
+
+    def add_verbose_transaction(self, tx):
+        categories = classify_decoded_call(tx.get("decoded_call"))
+        if categories.liquidate:
+            self.liquidation_count += 1
+        if categories.repay:
+            self.repayment_count += 1
+        if categories.history:
+            timestamp = parse_block_timestamp(tx["block_timestamp"])
+            if self.oldest_lending_interaction is None or timestamp < self.oldest_lending_interaction:
+                self.oldest_lending_interaction = timestamp
+
+    def consume_history(self, transactions):
+        for tx in transactions:
+            self.add_history_transaction(tx)
+        return self
+
+    def consume_verbose(self, transactions):
+        for tx in transactions:
+            self.add_verbose_transaction(tx)
+        return self
+
+    def transaction_history_features(self, creation_date):
+        """
+        Build the Transaction History feature group from the accumulated wallet history.
+        """
         today = datetime.now(timezone.utc)
         wallet_age_months = max(1, (today.year - creation_date.year) * 12 + (today.month - creation_date.month))
-        transaction_frequency = len(transactions) / wallet_age_months
-        transaction_volume = sum(int(tx.get("value", 0)) / 10**18 for tx in transactions)  # Convert from Wei to ETH
-        largest_transaction = max(int(tx.get("value", 0)) / 10**18 for tx in transactions)
-        average_transaction_value = transaction_volume / len(transactions) if len(transactions) > 0 else 0
-
-        transaction_history = {
+        transaction_frequency = self.transaction_count / wallet_age_months
+        average_transaction_value = self.transaction_volume / self.transaction_count if self.transaction_count > 0 else 0
+        return {
             "TransactionFrequency": round(transaction_frequency, 2),
-            "TransactionVolume": round(transaction_volume, 4),
-            "LargestTransaction": round(largest_transaction, 4),
+            "TransactionVolume": round(self.transaction_volume, 4),
+            "LargestTransaction": round(self.largest_transaction, 4),
             "AverageTransactionValue": round(average_transaction_value, 4),
         }
-    else:
-        transaction_history = {
-            "TransactionFrequency": 0,
-            "TransactionVolume": 0,
-            "LargestTransaction": 0,
-            "AverageTransactionValue": 0,
-        }
 
-    # Liquidation History
-    if defi_positions:
-        liquidation_event_count = calculate_liquidation_event_count(wallet_address)
-        avg_health_data = calculate_average_health_and_apy(defi_positions)
-        collateral_utilization = calculate_collateral_utilization(defi_positions)
-        liquidation_history = {
-            "LiquidationEventCount": liquidation_event_count,
-            **avg_health_data,
-            "CollateralUtilization": collateral_utilization,
-        }
-    else:
-        liquidation_history = {
+
+def resolve_creation_date(data):
+    """
+    Determine the wallet creation date for a WalletData bundle.
+
+    When the bundle has already fetched the full history, its oldest entry is the
+    wallet's first transaction. Otherwise the single oldest-first lookup is made right
+    away instead of waiting for the history: paging a long history could use up the
+    deadline or page budget the lookup needs.
+    """
+    if data.loaded("transaction_history") and data.history_complete():
+        timestamp = data.transaction_history.oldest_history_timestamp
+        return parse_block_timestamp(timestamp) if timestamp else None
+    return fetch_wallet_creation_date(data.wallet_address, data.budget)
+
+
+# Shared by every WalletData bundle, so the fetch threads are bounded per process rather than per request
+_fetch_executor = ThreadPoolExecutor(max_workers=FETCH_THREADS)
+
+# Moralis datasets a WalletData bundle can hold, keyed by name. Each loader receives the
+# bundle; the transaction streams are folded into its TransactionFeatureEngine.
+WALLET_DATA_SOURCES = {
+    "transaction_history": lambda data: data.engine.consume_history(
+        iter_transaction_data(data.wallet_address, data.budget)),
+    "verbose_transactions": lambda data: data.engine.consume_verbose(
+        iter_wallet_transactions(data.wallet_address, data.budget)),
+    "defi_positions": lambda data: fetch_defi_positions(data.wallet_address, data.budget),
+    "creation_date": lambda data: resolve_creation_date(data),
+    "net_worth": lambda data: fetch_wallet_net_worth(data.wallet_address, data.budget),
+    "token_swap_count": lambda data: calculate_token_swap_count(data.wallet_address, data.budget),
+    "oldest_lending_interaction": lambda data: fetch_oldest_lending_interaction(data.wallet_address, data.budget),
+}
+
+
+class WalletData:
+    """
+    Per-request bundle of the Moralis datasets used to engineer a wallet's features.
+
+    Each dataset is fetched at most once, so every feature function reading from the
+    same bundle shares a single set of API calls. Transaction histories are streamed
+    through a TransactionFeatureEngine and never held in memory. Datasets can be
+    prefetched in the background so independent sources are paged concurrently;
+    reading one that is still in flight waits for it instead of fetching it again.
+
+    All calls made for the bundle share one FetchBudget, so a wallet with a huge history
+    stops paging once the budget is spent. The budget also records calls that failed
+    after retries; incomplete_features() then reports which features were computed from
+    truncated or failed fetches or fell back to defaults.
+
+    Fetches run on the process-wide fetch pool, at most max_workers at a time per bundle.
+    """
+
+    def __init__(self, wallet_address, max_workers=FETCH_CONCURRENCY, budget=None):
+        self.wallet_address = wallet_address
+        self.budget = budget if budget is not None else FetchBudget(FEATURE_MAX_PAGES, FEATURE_MAX_SECONDS)
+        self.engine = TransactionFeatureEngine()
+        self._max_workers = max_workers
+        self._running = 0
+        self._pending = deque()
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _future(self, name):
+        with self._lock:
+            future = self._futures.get(name)
+            if future is None:
+                future = self._futures[name] = Future()
+                self._pending.append((name, future))
+                self._start_pending()
+            return future
+
+    def _start_pending(self):
+        """
+        Hand queued fetches to the fetch pool while the bundle is under max_workers.
+        Must be called with the lock held.
+        """
+        while self._pending and self._running < self._max_workers:
+            name, future = self._pending.popleft()
+            if future.set_running_or_notify_cancel():
+                self._running += 1
+                _fetch_executor.submit(self._load, name, future)
+
+    def _load(self, name, future):
+        try:
+            result = WALLET_DATA_SOURCES[name](self)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._start_pending()
+
+    def prefetch(self, *names):
+        """
+        Start fetching the given datasets in the background without waiting for them.
+        """
+        for name in names:
+            self._future(name)
+
+    def get(self, name):
+        """
+        Return a dataset, fetching it first if it has not been requested yet.
+        """
+        return self._future(name).result()
+
+    def has(self, name):
+        """
+        Check whether a dataset has already been requested (fetched or in flight).
+        """
+        with self._lock:
+            return name in self._futures
+
+    def loaded(self, name):
+        """
+        Check whether a dataset has been fetched (requested and no longer in flight).
+        """
+        with self._lock:
+            future = self._futures.get(name)
+        return future is not None and future.done()
+
+    def close(self):
+        """
+        Drop the fetches that have not started. Fetches in flight run to completion.
+        """
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+
+    def incomplete_features(self, features=None):
+        """
+        Report the features affected by the fetch budget running out or by failed fetches.
+
+        Args:
+            features (list, optional): Restrict the report to these features.
+
+        Returns:
+            dict: "truncated" lists features computed from partially paged data,
+            "estimated" lists features whose source was skipped by the budget and
+            therefore hold default values, and "failed" lists features whose source
+            failed after retries. All are empty when every source was fetched in full.
+        """
+        def features_of(endpoints):
+            return {f for endpoint in endpoints for f in ENDPOINT_FEATURES[endpoint]}
+
+        estimated = features_of(self.budget.skipped)
+        failed = features_of(self.budget.failed) - estimated
+        truncated = features_of(self.budget.truncated) - estimated - failed
+        report = {"truncated": truncated, "estimated": estimated, "failed": failed}
+        if features is not None:
+            report = {kind: names & set(features) for kind, names in report.items()}
+        return {kind: sorted(names) for kind, names in report.items()}
+
+    def is_complete(self, features=None):
+        """
+        Check whether every feature (or every one of the given features) was computed
+        from fully fetched data.
+        """
+        return not any(self.incomplete_features(features).values())
+
+    def history_complete(self):
+        """
+        Check whether the wallet history was requested and fetched in full, without errors.
+        """
+        if not self.has("transaction_history"):
+            return False
+        self.get("transaction_history")
+        budget = self.budget
+        return not {"wallet_history"} & (budget.truncated | budget.skipped | budget.failed)
+
+    def confirmed_empty(self):
+        """
+        Check whether the wallet history was fetched in full, without errors, and holds no transactions.
+        """
+        return self.history_complete() and not self.transaction_history.transaction_count
+
+
+    @property
+    def transaction_history(self):
+        """Engine after the wallet history (get_wallet_history) has been streamed through it."""
+        return self.get("transaction_history")
+
+    @property
+    def verbose_transactions(self):
+        """Engine after the decoded transactions (get_wallet_transactions_verbose) have been streamed through it."""
+        return self.get("verbose_transactions")
+
+    @property
+    def defi_positions(self):
+        return self.get("defi_positions")
+
+    @property
+    def creation_date(self):
+        return self.get("creation_date")
+
+    @property
+    def net_worth(self):
+        return self.get("net_worth")
+
+    @property
+    def token_swap_count(self):
+        return self.get("token_swap_count")
+
+    @property
+    def oldest_lending_interaction(self):
+        """
+        Timestamp of the first lending/borrowing interaction. Reuses the verbose stream
+        when it is already being fetched, otherwise streams the history oldest first.
+        """
+        if self.has("verbose_transactions"):
+            return self.verbose_transactions.oldest_lending_interaction
+        return self.get("oldest_lending_interaction")
+
+
+# Builders of each feature group. Each receives the bundle, the wallet's DeFi positions
+# (empty if not needed or none held) and the set of requested features, and reads only
+# the sources those features depend on.
+def build_transaction_history(data, defi_positions, wanted):
+    engine = data.transaction_history
+    creation_date = data.creation_date
+    if engine.transaction_count and creation_date:
+        return engine.transaction_history_features(creation_date)
+    return {
+        "TransactionFrequency": 0,
+        "TransactionVolume": 0,
+        "LargestTransaction": 0,
+        "AverageTransactionValue": 0,
+    }
+
+def build_liquidation_history(data, defi_positions, wanted):
+    if not defi_positions:
+        return {
             "LiquidationEventCount": 0,
             "AverageHealthFactor": 0.0,
             "CollateralUtilization": 0.0,
         }
+    liquidation_event_count = (
+        data.verbose_transactions.liquidation_count if "LiquidationEventCount" in wanted else None
+    )
+    avg_health_data = calculate_average_health_and_apy(defi_positions)
+    collateral_utilization = calculate_collateral_utilization(defi_positions)
+    return {
+        "LiquidationEventCount": liquidation_event_count,
+        **avg_health_data,
+        "CollateralUtilization": collateral_utilization,
+    }
 
-    # Debt and Repayments
-    if defi_positions:
-        total_outstanding_debt = calculate_total_outstanding_debt(defi_positions)
-        avg_debt_size = total_outstanding_debt / max(1, len(defi_positions))
-        debt_to_asset_ratio = round(total_outstanding_debt / max(1, fetch_wallet_net_worth(wallet_address)), 4)
-        repayment_activity_proxy = calculate_repayment_activity_proxy(wallet_address)
-        earnings_efficiency = calculate_earnings_efficiency(defi_positions)
-        debt_and_repayments = {
-            "TotalOutstandingDebt": total_outstanding_debt,
-            "AverageDebtSize": avg_debt_size,
-            "DebtToAssetRatio": debt_to_asset_ratio,
-            "RepaymentActivityProxy": repayment_activity_proxy,
-            "EarningsEfficiency": earnings_efficiency,
-        }
-    else:
-        debt_and_repayments = {
+def build_debt_and_repayments(data, defi_positions, wanted):
+    if not defi_positions:
+        return {
             "TotalOutstandingDebt": 0,
             "AverageDebtSize": 0,
             "DebtToAssetRatio": 0.0,
             "RepaymentActivityProxy": 0,
             "EarningsEfficiency": 0.0,
         }
+    total_outstanding_debt = calculate_total_outstanding_debt(defi_positions)
+    avg_debt_size = total_outstanding_debt / max(1, len(defi_positions))
+    debt_to_asset_ratio = (
+        round(total_outstanding_debt / max(1, data.net_worth), 4) if "DebtToAssetRatio" in wanted else None
+    )
+    repayment_activity_proxy = (
+        data.verbose_transactions.repayment_count if "RepaymentActivityProxy" in wanted else None
+    )
+    earnings_efficiency = calculate_earnings_efficiency(defi_positions)
+    return {
+        "TotalOutstandingDebt": total_outstanding_debt,
+        "AverageDebtSize": avg_debt_size,
+        "DebtToAssetRatio": debt_to_asset_ratio,
+        "RepaymentActivityProxy": repayment_activity_proxy,
+        "EarningsEfficiency": earnings_efficiency,
+    }
 
-    # Credit Mix
-    if defi_positions:
-        protocol_diversity = calculate_protocol_diversity(defi_positions)
-        lending_protocol_count = calculate_lending_protocol_count(defi_positions)
-        liquidity_provision_count = calculate_liquidity_provision_count(defi_positions)
-        token_swap_count = calculate_token_swap_count(wallet_address)
-        credit_mix = {
-            "ProtocolDiversity": protocol_diversity,
-            "LendingProtocolCount": lending_protocol_count,
-            "LiquidityProvisionCount": liquidity_provision_count,
-            "TokenSwapCount": token_swap_count,
-        }
-    else:
-        credit_mix = {
+def build_credit_mix(data, defi_positions, wanted):
+    if not defi_positions:
+        return {
             "ProtocolDiversity": 0,
             "LendingProtocolCount": 0,
             "LiquidityProvisionCount": 0,
             "TokenSwapCount": 0,
         }
+    protocol_diversity = calculate_protocol_diversity(defi_positions)
+    lending_protocol_count = calculate_lending_protocol_count(defi_positions)
+    liquidity_provision_count = calculate_liquidity_provision_count(defi_positions)
+    token_swap_count = data.token_swap_count if "TokenSwapCount" in wanted else None
+    return {
+        "ProtocolDiversity": protocol_diversity,
+        "LendingProtocolCount": lending_protocol_count,
+        "LiquidityProvisionCount": liquidity_provision_count,
+        "TokenSwapCount": token_swap_count,
+    }
 
-    # Length of Credit History
-    if creation_date:
-        wallet_age = (datetime.now(timezone.utc) - creation_date).days
-        defi_engagement_duration = calculate_defi_engagement_duration(wallet_address)
-        length_of_credit_history = {
-            "WalletAgeInDays": wallet_age,
-            "DeFiEngagementDurationInDays": defi_engagement_duration,
-        }
-    else:
-        length_of_credit_history = {
+def build_length_of_credit_history(data, defi_positions, wanted):
+    creation_date = data.creation_date
+    if not creation_date:
+        return {
             "WalletAgeInDays": 0,
             "DeFiEngagementDurationInDays": 0,
         }
-
-    # Combine all categories into a single dictionary
-    features = {
-        **transaction_history,
-        **liquidation_history,
-        **debt_and_repayments,
-        **credit_mix,
-        **length_of_credit_history,
+    wallet_age = (datetime.now(timezone.utc) - creation_date).days
+    defi_engagement_duration = (
+        calculate_defi_engagement_duration(data.oldest_lending_interaction)
+        if "DeFiEngagementDurationInDays" in wanted else None
+    )
+    return {
+        "WalletAgeInDays": wallet_age,
+        "DeFiEngagementDurationInDays": defi_engagement_duration,
     }
-    return features
+
+FEATURE_GROUP_BUILDERS = {
+    "TransactionHistory": build_transaction_history,
+    "LiquidationHistory": build_liquidation_history,
+    "DebtAndRepayments": build_debt_and_repayments,
+    "CreditMix": build_credit_mix,
+    "LengthOfCreditHistory": build_length_of_credit_history,
+}
+
+def prefetch_for(data, wanted):
+    """
+    Start fetching the sources the wanted features depend on.
+
+    Returns:
+        list: The wallet's DeFi positions, or an empty list if they are not needed.
+    """
+    initial_sources, position_sources = plan_fetches(wanted)
+    # Fetch shared data concurrently. The remaining sources are only used when the
+    # wallet holds DeFi positions, so they are started once that is known.
+    data.prefetch(*initial_sources)
+    defi_positions = data.defi_positions if "defi_positions" in initial_sources else []
+    if defi_positions:
+        data.prefetch(*position_sources)
+    return defi_positions
+
+def calculate_all_features(wallet_address, data=None, features=None):
+    """
+    Engineer the feature set for a wallet.
+
+    Only the Moralis sources the requested features depend on are fetched (see
+    plan_fetches), so a caller asking for a subset pays only for that subset.
+
+    Args:
+        wallet_address (str): Wallet address to analyze.
+        data (WalletData, optional): Pre-built data bundle to read from. A new one is created if omitted.
+        features (list, optional): Feature and/or group names to compute. All features if omitted.
+
+    Returns:
+        dict: Feature name to value, for the requested features.
+    """
+    if data is None:
+        data = WalletData(wallet_address)
+        try:
+            return calculate_all_features(wallet_address, data, features)
+        finally:
+            data.close()
+
+    started = time.monotonic()
+    wanted = set(resolve_features(features))
+    defi_positions = prefetch_for(data, wanted)
+    return build_features(data, defi_positions, wanted, started)
+
+def build_group(group, data, defi_positions, wanted, started):
+    """
+    Build one feature group and record how long after started (when the extraction
+    began fetching) its values were ready.
+    """
+    values = FEATURE_GROUP_BUILDERS[group](data, defi_positions, wanted)
+    metrics.feature_group_seconds.observe(time.monotonic() - started, group)
+    return values
+
+def build_features(data, defi_positions, wanted, started):
+    """
+    Build every feature group holding a wanted feature and keep the wanted features.
+    """
+    # Combine all categories into a single dictionary, keeping the requested features
+    all_features = {}
+    for group in FEATURE_GROUP_BUILDERS:
+        if wanted.intersection(FEATURE_GROUPS[group]):
+            all_features.update(build_group(group, data, defi_positions, wanted, started))
+    return {name: value for name, value in all_features.items() if name in wanted}
+
+def iter_feature_groups(wallet_address, data, features=None):
+    """
+    Engineer the feature set for a wallet group by group, yielding each group as soon
+    as its sources are in, so cheap groups are not held back by long paginations.
+
+    Args:
+        wallet_address (str): Wallet address to analyze.
+        data (WalletData): Data bundle to read from.
+        features (list, optional): Feature and/or group names to compute. All features if omitted.
+
+    Yields:
+        tuple: (group name, dict of feature name to value) in completion order.
+    """
+    started = time.monotonic()
+    wanted = set(resolve_features(features))
+    defi_positions = prefetch_for(data, wanted)
+    groups = [group for group in FEATURE_GROUP_BUILDERS if wanted.intersection(FEATURE_GROUPS[group])]
+    # Builders block on their sources, so they run on their own threads rather than the bundle's fetch workers
+    executor = ThreadPoolExecutor(max_workers=max(1, len(groups)))
+    try:
+        futures = {
+            executor.submit(build_group, group, data, defi_positions, wanted, started): group for group in groups
+        }
+        for future in as_completed(futures):
+            values = future.result()
+            yield futures[future], {name: value for name, value in values.items() if name in wanted}
+    finally:
+        executor.shutdown(wait=False)
 
 if __name__ == "__main__":
     wallet_address = input("Enter wallet address: ")
@@ -0,0 +1,333 @@
+"""
+Incremental sync of wallet history (get_wallet_history).
+
+Each wallet's history is stored locally together with a sync state recording the
+newest transaction already seen. A later sync pages the history newest first and
+stops as soon as it reaches that transaction, so rescoring a wallet only costs API
+calls for its new activity. New pages are staged on disk as they arrive and the
+history is read back as a stream, so memory stays bounded by the page size.
+
+A walk cut short by the fetch budget still stores what it fetched, and records a
+backfill for the part of the history below it: later syncs first fetch the new
+activity, then continue the backfill from the oldest block stored, so a wallet too
+large for one budget is synced over several requests instead of re-paged from the
+head every time.
+
+The sync is a walk (see moralis_client): both the synchronous pipeline and the async
+one in async_features.py run sync_walk, each making its calls with its own client.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from moralis_client import BudgetExhausted, end_paging, run_walk
+
+# Set HISTORY_STORE_PATH to an empty string to always page the full history
+HISTORY_STORE_PATH = os.environ.get(
+    "HISTORY_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "wallet_history.sqlite3"),
+)
+
+# Query parameters of the history walk, newest first; a backfill resumes below a block with to_block
+HISTORY_PARAMS = {"chain": "eth", "order": "DESC", "limit": 100}
+# Sequence numbers left free below transactions stored ahead of a gap, for its backfill
+BACKFILL_SEQ_GAP = 1 << 32
+
+_local = threading.local()
+_wallet_locks = {}
+_wallet_locks_lock = threading.Lock()
+
+
+def _connection():
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        os.makedirs(os.path.dirname(HISTORY_STORE_PATH) or ".", exist_ok=True)
+        connection = sqlite3.connect(HISTORY_STORE_PATH, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS transactions (
+                wallet TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (wallet, hash)
+            );
+            CREATE INDEX IF NOT EXISTS transactions_by_seq ON transactions (wallet, seq);
+            CREATE TABLE IF NOT EXISTS staging (
+                sync_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                hash TEXT,
+                block_number INTEGER NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (sync_id, idx)
+            );
+            CREATE TABLE IF NOT EXISTS sync_state (
+                wallet TEXT PRIMARY KEY,
+                newest_hash TEXT,
+                newest_block INTEGER,
+                synced_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS backfill_state (
+                wallet TEXT PRIMARY KEY,
+                next_block INTEGER NOT NULL,
+                next_seq INTEGER NOT NULL,
+                stop_hash TEXT,
+                stop_block INTEGER
+            );
+            """
+        )
+        _local.connection = connection
+    return connection
+
+
+@contextmanager
+def _wallet_lock(wallet):
+    """
+    Hold the wallet's sync lock. Locks are dropped once no sync holds or waits for them,
+    so there is no lock per wallet ever seen.
+    """
+    with _wallet_locks_lock:
+        entry = _wallet_locks.setdefault(wallet, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _wallet_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _wallet_locks[wallet]
+
+
+def get_sync_state(wallet_address):
+    """
+    Return (newest_hash, newest_block) already stored for a wallet, or (None, None).
+    """
+    row = _connection().execute(
+        "SELECT newest_hash, newest_block FROM sync_state WHERE wallet = ?", (wallet_address.lower(),)
+    ).fetchone()
+    return row if row else (None, None)
+
+
+def iter_history(wallet_address):
+    """
+    Yield the stored history for a wallet, newest first, without loading it all into memory.
+    """
+    rows = _connection().execute(
+        "SELECT body FROM transactions WHERE wallet = ? ORDER BY seq DESC", (wallet_address.lower(),)
+    )
+    for (body,) in rows:
+        yield json.loads(body)
+
+
+def _stage_walk(sync_id, newest_hash, newest_block, budget=None):
+    """
+    Walk paging the wallet history newest first into the staging table until the
+    already-synced transaction is reached.
+
+    Returns:
+        tuple: (number of transactions staged, whether the walk completed without errors).
+    """
+    params = dict(HISTORY_PARAMS)
+    staged = 0
+    while True:
+        try:
+            result = yield "wallet_history", dict(params), True
+        except Exception as e:
+            end_paging("wallet_history", params, budget, e)
+            return staged, False
+
+        count, reached_synced = stage_page(sync_id, staged, result, newest_hash, newest_block)
+        staged += count
+
+        cursor = result.get("cursor")
+        if reached_synced or not cursor:
+            return staged, True
+        params["cursor"] = cursor
+
+
+def stage_page(sync_id, staged, result, newest_hash, newest_block):
+    """
+    Stage the transactions of one history page that are newer than the synced ones.
+
+    Returns:
+        tuple: (number of transactions staged, whether the already-synced transaction was reached).
+    """
+    rows = []
+    reached_synced = False
+    for tx in result.get("result", []):
+        block_number = int(tx.get("block_number") or 0)
+        if tx.get("hash") == newest_hash or (newest_block is not None and block_number < newest_block):
+            reached_synced = True
+            break
+        rows.append((sync_id, staged + len(rows), tx.get("hash"), block_number, json.dumps(tx)))
+    connection = _connection()
+    with connection:
+        connection.executemany("INSERT INTO staging VALUES (?, ?, ?, ?, ?)", rows)
+    return len(rows), reached_synced
+
+
+def commit_staged(wallet, sync_id, staged, complete=True, synced=(None, None)):
+    """
+    Move the transactions staged by a sync into the stored history and record the new
+    sync state.
+
+    When the walk was cut short (complete is False), the transactions are stored above a
+    range of free sequence numbers and a backfill is recorded to fill it, from the
+    oldest staged block down to the newest transaction synced before (synced, as
+    returned by get_sync_state) or to the start of the history.
+    """
+    connection = _connection()
+    with connection:
+        (max_seq,) = connection.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM transactions WHERE wallet = ?", (wallet,)
+        ).fetchone()
+        base_seq = max_seq if complete else max_seq + BACKFILL_SEQ_GAP
+        # Staged rows are newest first, so the oldest new transaction gets the lowest sequence number
+        connection.execute(
+            """
+            INSERT OR IGNORE INTO transactions (wallet, hash, seq, body)
+            SELECT ?, hash, ? + (? - idx), body FROM staging WHERE sync_id = ?
+            """,
+            (wallet, base_seq, staged, sync_id),
+        )
+        newest = connection.execute(
+            "SELECT hash, block_number FROM staging WHERE sync_id = ? AND idx = 0", (sync_id,)
+        ).fetchone()
+        if newest:
+            connection.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)", (wallet, newest[0], newest[1], time.time())
+            )
+        oldest = connection.execute(
+            "SELECT block_number FROM staging WHERE sync_id = ? AND idx = ?", (sync_id, staged - 1)
+        ).fetchone()
+        if oldest and not complete:
+            connection.execute(
+                "INSERT OR REPLACE INTO backfill_state VALUES (?, ?, ?, ?, ?)",
+                (wallet, oldest[0], base_seq, synced[0], synced[1]),
+            )
+        connection.execute("DELETE FROM staging WHERE sync_id = ?", (sync_id,))
+
+
+def get_backfill(wallet):
+    """
+    Return the oldest block stored so far by a wallet's pending backfill, or None if its
+    stored history has no gap.
+    """
+    row = _connection().execute("SELECT next_block FROM backfill_state WHERE wallet = ?", (wallet,)).fetchone()
+    return row[0] if row else None
+
+
+def store_backfill_page(wallet, result):
+    """
+    Store one page of a backfill walk into the gap of a wallet's stored history.
+
+    Returns:
+        bool: Whether the backfill is finished (the gap is filled).
+    """
+    connection = _connection()
+    with connection:
+        next_block, next_seq, stop_hash, stop_block = connection.execute(
+            "SELECT next_block, next_seq, stop_hash, stop_block FROM backfill_state WHERE wallet = ?", (wallet,)
+        ).fetchone()
+        rows = []
+        done = not result.get("cursor")
+        for tx in result.get("result", []):
+            block_number = int(tx.get("block_number") or 0)
+            if tx.get("hash") == stop_hash or (stop_block is not None and block_number < stop_block):
+                done = True
+                break
+            rows.append((wallet, tx.get("hash"), next_seq - len(rows), json.dumps(tx)))
+            next_block = block_number
+        # The walk resumes at the oldest block stored, so transactions of that block fetched
+        # again are already stored and ignored
+        connection.executemany("INSERT OR IGNORE INTO transactions (wallet, hash, seq, body) VALUES (?, ?, ?, ?)", rows)
+        if done:
+            connection.execute("DELETE FROM backfill_state WHERE wallet = ?", (wallet,))
+        else:
+            connection.execute(
+                "UPDATE backfill_state SET next_block = ?, next_seq = ? WHERE wallet = ?",
+                (next_block, next_seq - len(rows), wallet),
+            )
+    return done
+
+
+def _backfill_walk(wallet, budget=None):
+    """
+    Walk paging the history below the oldest block stored by the wallet's pending
+    backfill into its gap, page by page, until it is filled or the budget runs out.
+
+    Returns:
+        bool: Whether the stored history is complete.
+    """
+    next_block = get_backfill(wallet)
+    if next_block is None:
+        return True
+    if budget is not None and budget.exhausted():
+        return False
+    params = {**HISTORY_PARAMS, "to_block": next_block}
+    while True:
+        try:
+            result = yield "wallet_history", dict(params), True
+        except BudgetExhausted:
+            return False
+        except Exception as e:
+            print(f"Error backfilling transaction data: {e}")
+            return False
+        if store_backfill_page(wallet, result):
+            return True
+        params["cursor"] = result["cursor"]
+
+
+def iter_partial(wallet, sync_id):
+    """
+    Yield the transactions staged by an incomplete sync followed by the stored history,
+    then discard the staged rows.
+    """
+    connection = _connection()
+    try:
+        rows = connection.execute("SELECT body FROM staging WHERE sync_id = ? ORDER BY idx", (sync_id,))
+        for (body,) in rows:
+            yield json.loads(body)
+        yield from iter_history(wallet)
+    finally:
+        with connection:
+            connection.execute("DELETE FROM staging WHERE sync_id = ?", (sync_id,))
+
+
+def sync_walk(wallet_address, budget=None):
+    """
+    Walk bringing the stored history for a wallet up to date, returning it as a stream,
+    newest first.
+
+    Only pages newer than the stored sync state are fetched, then a pending backfill is
+    continued with what is left of the budget. If the walk fails or runs out of budget
+    part way, what it fetched is stored with a backfill recorded for the gap below it;
+    while another backfill is pending, the new transactions are instead only streamed
+    ahead of the stored history. The history is marked truncated in the budget while it
+    has a gap. The caller holds the wallet's sync lock.
+    """
+    wallet = wallet_address.lower()
+    sync_id = uuid.uuid4().hex
+    newest_hash, newest_block = get_sync_state(wallet)
+    staged, completed = yield from _stage_walk(sync_id, newest_hash, newest_block, budget)
+    if completed or (staged and get_backfill(wallet) is None):
+        commit_staged(wallet, sync_id, staged, completed, (newest_hash, newest_block))
+        if not (yield from _backfill_walk(wallet, budget)) and budget is not None:
+            budget.mark_truncated("wallet_history")
+        return iter_history(wallet)
+    return iter_partial(wallet, sync_id)
+
+
+def sync_wallet_history(wallet_address, budget=None):
+    """
+    Bring the stored history for a wallet up to date as described in sync_walk and
+    return it as a stream, newest first.
+    """
+    with _wallet_lock(wallet_address.lower()):
+        return run_walk(sync_walk(wallet_address, budget), wallet_address, budget)
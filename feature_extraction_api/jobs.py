@@ -0,0 +1,98 @@
+"""
+Background jobs for slow wallet extractions.
+
+A job is queued on a worker pool and answered immediately with its id; clients poll
+(or long-poll) for the outcome. Job records live in a ResultCache under their own TTL,
+so with FEATURE_CACHE_SHARED_PATH set any gunicorn worker can answer for a job started
+by another.
+"""
+import os
+import threading
+import time
+import uuid
+
+from feature_cache import FEATURE_CACHE_SHARED_PATH, ResultCache
+from lanes import BACKGROUND, LaneExecutor
+
+# Extractions run concurrently by the job workers of each process, per lane
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+# Seconds a job record (and its result) is kept after it was last updated
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", 3600))
+JOB_STORE_MAX_BYTES = int(os.environ.get("JOB_STORE_MAX_BYTES", 64 * 1024 * 1024))
+# Longest a status request may long-poll, in seconds
+JOB_MAX_WAIT = float(os.environ.get("JOB_MAX_WAIT", 30))
+# Interval at which a long-poll for a job owned by another process rechecks the store
+JOB_POLL_INTERVAL = 0.5
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue:
+    """
+    Worker pool running jobs in the background and recording their outcome in a store.
+    Each priority lane has its own workers, so jobs of one lane do not queue behind
+    another lane's backlog.
+    """
+
+    def __init__(self, store, max_workers=JOB_WORKERS):
+        self.store = store
+        self._executor = LaneExecutor(max_workers)
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, lane=BACKGROUND):
+        """
+        Queue fn(*args) in the lane's workers and return the new job's record, whose
+        jobId identifies it.
+        """
+        job_id = uuid.uuid4().hex
+        record = {"jobId": job_id, "status": PENDING, "submittedAt": time.time()}
+        self.store.put(job_id, record)
+        with self._lock:
+            self._events[job_id] = threading.Event()
+        self._executor.submit(lane, self._run, record, fn, args)
+        return record
+
+    def _run(self, record, fn, args):
+        job_id = record["jobId"]
+        self.store.put(job_id, {**record, "status": RUNNING, "startedAt": time.time()})
+        try:
+            outcome = {"status": DONE, "result": fn(*args)}
+        except Exception as e:
+            print(f"Error running job {job_id}: {e}")
+            outcome = {"status": FAILED, "error": str(e)}
+        self.store.put(job_id, {**record, **outcome, "completedAt": time.time()})
+        with self._lock:
+            event = self._events.pop(job_id)
+        event.set()
+
+    def get(self, job_id, wait=0):
+        """
+        Return the record of a job, or None if it is unknown or expired.
+
+        Args:
+            job_id (str): Id returned by submit.
+            wait (float): Seconds to wait for a pending or running job to finish (long-poll).
+        """
+        deadline = time.monotonic() + min(max(wait, 0), JOB_MAX_WAIT)
+        while True:
+            cached = self.store.get(job_id, prefer_shared=True)
+            if cached is None:
+                return None
+            record, _ = cached
+            remaining = deadline - time.monotonic()
+            if record["status"] in (DONE, FAILED) or remaining <= 0:
+                return record
+            with self._lock:
+                event = self._events.get(job_id)
+            if event is not None:
+                # Job runs in this process: wake as soon as it finishes
+                event.wait(remaining)
+            else:
+                time.sleep(min(JOB_POLL_INTERVAL, remaining))
+
+
+job_queue = JobQueue(ResultCache(JOB_RESULT_TTL, JOB_STORE_MAX_BYTES, FEATURE_CACHE_SHARED_PATH, namespace="jobs"))
@@ -0,0 +1,235 @@
+"""
+Priority lanes for Moralis compute units and extraction worker slots.
+
+Every extraction runs in a lane: interactive (single-wallet lookups), batch (the
+multi-wallet endpoints) or background (jobs and the dataset collection pipeline). When
+a resource is contended, the lanes waiting for it are served by weighted fair queueing,
+so each backlogged lane gets a share proportional to its weight and a bulk backlog
+cannot starve interactive lookups. In addition each lane has a floor: a share of the
+capacity the other lanes leave untouched while it is idle, so its first call does not
+queue behind another lane's backlog.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+BACKGROUND = "background"
+LANES = (INTERACTIVE, BATCH, BACKGROUND)
+DEFAULT_LANE = INTERACTIVE
+
+# Share of a contended resource each backlogged lane receives, relative to the others
+LANE_WEIGHTS = {
+    INTERACTIVE: float(os.environ.get("LANE_WEIGHT_INTERACTIVE", 6)),
+    BATCH: float(os.environ.get("LANE_WEIGHT_BATCH", 3)),
+    BACKGROUND: float(os.environ.get("LANE_WEIGHT_BACKGROUND", 1)),
+}
+# Fraction of each resource's capacity held back for a lane while it is idle
+LANE_FLOORS = {
+    INTERACTIVE: float(os.environ.get("LANE_FLOOR_INTERACTIVE", 0.2)),
+    BATCH: float(os.environ.get("LANE_FLOOR_BATCH", 0.1)),
+    BACKGROUND: float(os.environ.get("LANE_FLOOR_BACKGROUND", 0.05)),
+}
+
+# Extractions that may run at once in each process, across every lane
+EXTRACTION_SLOTS = int(os.environ.get("EXTRACTION_SLOTS", 8))
+
+# Longest an asyncio waiter sleeps before checking its place in a queue again
+ASYNC_POLL_INTERVAL = 0.02
+
+
+def resolve_lane(lane, default=DEFAULT_LANE):
+    """
+    Return a valid lane name for a requested lane, falling back to the default.
+
+    Raises:
+        ValueError: If the lane is not one of LANES.
+    """
+    if lane is None:
+        return default
+    if lane not in LANES:
+        raise ValueError(f"priority must be one of: {', '.join(LANES)}")
+    return lane
+
+
+class _Waiter:
+    __slots__ = ("lane", "cost")
+
+    def __init__(self, lane, cost):
+        self.lane = lane
+        self.cost = cost
+
+
+class FairQueue:
+    """
+    Waiters of every lane for one resource, ordered by weighted fair queueing.
+
+    Each lane has a virtual time that advances by cost / weight whenever it is served;
+    the backlogged lane with the lowest virtual time goes next. Not thread-safe: the
+    resource using it serializes access under its own lock.
+    """
+
+    def __init__(self, weights=None, floors=None):
+        self.weights = weights if weights is not None else LANE_WEIGHTS
+        self.floors = floors if floors is not None else LANE_FLOORS
+        self.waiting = {lane: deque() for lane in LANES}
+        self.virtual = dict.fromkeys(LANES, 0.0)
+        self.served = dict.fromkeys(LANES, 0)
+
+    def join(self, lane, cost):
+        if not self.waiting[lane]:
+            # A lane coming back from idle starts level with the lanes already waiting,
+            # instead of spending credit it built up while it had nothing to do
+            backlogged = [self.virtual[other] for other in LANES if self.waiting[other]]
+            if backlogged:
+                self.virtual[lane] = max(self.virtual[lane], min(backlogged))
+        waiter = _Waiter(lane, cost)
+        self.waiting[lane].append(waiter)
+        return waiter
+
+    def leave(self, waiter):
+        """
+        Remove a waiter that gives up. Waiters already served are ignored.
+        """
+        try:
+            self.waiting[waiter.lane].remove(waiter)
+        except ValueError:
+            pass
+
+    def head(self, eligible=None):
+        """
+        Return the waiter to serve next, or None if no lane is waiting. With eligible,
+        only lanes for which it returns True are considered.
+        """
+        backlogged = [lane for lane in LANES if self.waiting[lane] and (eligible is None or eligible(lane))]
+        if not backlogged:
+            return None
+        lane = min(backlogged, key=lambda lane: self.virtual[lane])
+        return self.waiting[lane][0]
+
+    def serve(self, waiter):
+        self.waiting[waiter.lane].popleft()
+        self.virtual[waiter.lane] += waiter.cost / self.weights[waiter.lane]
+        self.served[waiter.lane] += 1
+
+    def reserve(self, capacity, in_use=None):
+        """
+        Capacity held back for the floors of the lanes not waiting, less what those lanes
+        already hold (in_use, for resources that are given back).
+        """
+        in_use = in_use or {}
+        return sum(
+            max(0.0, self.floors[lane] * capacity - in_use.get(lane, 0)) for lane in LANES if not self.waiting[lane]
+        )
+
+    def depth(self):
+        return {lane: len(self.waiting[lane]) for lane in LANES}
+
+
+class SlotPool:
+    """
+    Fixed number of worker slots shared by the lanes, handed out in fair-queue order.
+    """
+
+    def __init__(self, slots=EXTRACTION_SLOTS, weights=None, floors=None):
+        self.slots = slots
+        self.in_use = dict.fromkeys(LANES, 0)
+        self.queue = FairQueue(weights, floors)
+        self._cond = threading.Condition()
+
+    def _eligible(self, lane):
+        free = self.slots - sum(self.in_use.values())
+        if free < 1:
+            return False
+        # A lane below its floor takes from its own reservation; otherwise it must leave
+        # the floors of the other lanes free. The reserve is capped so a lane can always
+        # use a slot when every other lane is idle.
+        if self.in_use[lane] < self.queue.floors[lane] * self.slots:
+            return True
+        return free - 1 >= min(self.queue.reserve(self.slots, self.in_use), self.slots - 1)
+
+    def _attempt(self, waiter):
+        """
+        Hand the waiter a slot if it is next in line and one is free. Must be called
+        with the lock held.
+        """
+        if self.queue.head(self._eligible) is not waiter:
+            return False
+        self.queue.serve(waiter)
+        self.in_use[waiter.lane] += 1
+        return True
+
+    def acquire(self, lane=DEFAULT_LANE, timeout=None):
+        """
+        Take a slot for the lane, waiting up to timeout seconds (forever if None).
+
+        Returns:
+            bool: Whether a slot was taken.
+        """
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            waiter = self.queue.join(lane, 1)
+            try:
+                while not self._attempt(waiter):
+                    remaining = give_up_at - time.monotonic() if give_up_at is not None else None
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self.queue.leave(waiter)
+                # The head may have changed
+                self._cond.notify_all()
+
+    async def acquire_async(self, lane=DEFAULT_LANE, timeout=None):
+        """
+        Awaitable version of acquire, checking for a slot every ASYNC_POLL_INTERVAL
+        seconds instead of blocking the thread.
+        """
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            waiter = self.queue.join(lane, 1)
+        try:
+            while True:
+                with self._cond:
+                    if self._attempt(waiter):
+                        return True
+                remaining = give_up_at - time.monotonic() if give_up_at is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                await asyncio.sleep(ASYNC_POLL_INTERVAL if remaining is None else min(remaining, ASYNC_POLL_INTERVAL))
+        finally:
+            with self._cond:
+                self.queue.leave(waiter)
+                self._cond.notify_all()
+
+    def release(self, lane=DEFAULT_LANE):
+        with self._cond:
+            self.in_use[lane] -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"slots": self.slots, "inUse": dict(self.in_use), "queued": self.queue.depth(),
+                    "served": dict(self.queue.served)}
+
+
+class LaneExecutor:
+    """
+    Thread pool per lane for work queued before it reaches a SlotPool, so a lane's
+    backlog (a 10,000-wallet stream, say) never holds the threads another lane needs to
+    get in line for a slot.
+    """
+
+    def __init__(self, max_workers_per_lane):
+        self._executors = {lane: ThreadPoolExecutor(max_workers=max_workers_per_lane) for lane in LANES}
+
+    def submit(self, lane, fn, *args):
+        return self._executors[lane].submit(fn, *args)
+
+
+extraction_slots = SlotPool()
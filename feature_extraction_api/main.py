@@ -1,29 +1,361 @@
-from flask import Flask, request, jsonify
+from concurrent.futures import as_completed
+from contextlib import contextmanager
+import json
+import math
+import os
+import time
+
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS  # Import CORS
-from features_extraction import calculate_all_features
+import metrics
+from circuit_breaker import CircuitOpen
+from features_extraction import (
+    FEATURE_GROUP_BUILDERS, FEATURE_GROUPS, WalletData, calculate_all_features, iter_feature_groups,
+)
+from jobs import job_queue
+from lanes import BACKGROUND, BATCH, INTERACTIVE, LaneExecutor, extraction_slots
+from rate_limiter import scheduler
+from service import (
+    INVALID_ADDRESS_ERROR, INVALID_LIMITS_ERROR, add_incomplete_flags, cached_response, extraction_key,
+    finish_response, is_valid_address, parse_budget_limits, parse_features, parse_lane, parse_wallet_request,
+    queued_budget, split_pending, wants_refresh,
+)
+from single_flight import SingleFlight
+
+# Wallets extracted concurrently per lane across all batch requests, and the largest batch accepted
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+BATCH_MAX_WALLETS = int(os.environ.get("BATCH_MAX_WALLETS", 500))
+STREAM_MAX_WALLETS = int(os.environ.get("STREAM_MAX_WALLETS", 10000))
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# Shared by every batch request so concurrent batches cannot multiply the load on Moralis.
+# Each lane has its own threads, so a large background stream cannot delay an
+# interactive batch before it even queues for an extraction slot.
+batch_executor = LaneExecutor(BATCH_CONCURRENCY)
+
+# Concurrent requests for the same wallet share one extraction, across threads and workers
+coalescer = SingleFlight()
+
+@app.before_request
+def start_request_metrics():
+    # Label by route pattern rather than path, so job ids do not create new series
+    g.metrics_route = request.url_rule.rule if request.url_rule else "other"
+    g.metrics_started = time.monotonic()
+    metrics.http_requests_in_flight.inc(g.metrics_route)
+
+@app.after_request
+def count_response(response):
+    metrics.http_requests.inc(g.metrics_route, str(response.status_code))
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    # Streamed responses tear the request down twice: once when the view returns and
+    # again when the stream_with_context generator closes
+    route = g.pop("metrics_route", None)
+    if route is not None:
+        metrics.http_requests_in_flight.dec(route)
+        metrics.http_request_seconds.observe(time.monotonic() - g.metrics_started, route)
+
+def extract_wallet(wallet_address, budget_limits, refresh=False, features=None, lane=INTERACTIVE):
+    """
+    Calculate the requested features (all by default) for one wallet and build its
+    response entry.
+
+    Cached results are served as described in cached_response, without calling Moralis.
+    Requests for the same normalized address and budget that arrive while an extraction
+    is in flight wait for it and share its result, computed in the lane of the request
+    that started it.
+    """
+    cached = cached_response(wallet_address, refresh, features)
+    if cached is not None:
+        return cached
+
+    # Time spent waiting on another worker's extraction of this wallet counts against the
+    # request deadline, like time queued for a slot
+    queued_at = time.monotonic()
+    key = extraction_key(wallet_address, budget_limits, features)
+    result, _ = coalescer.do(
+        key, lambda: compute_wallet(wallet_address, budget_limits, features, lane, queued_at),
+        timeout=budget_limits[2],
+    )
+    return {**result, "walletAddress": wallet_address, "cached": False, "cacheAgeSeconds": 0}
+
+@contextmanager
+def extraction_budget(budget_limits, lane, queued_at=None):
+    """
+    Wait for an extraction slot in the lane, then yield the FetchBudget for the
+    extraction, holding the slot until it is done. The budget is created once the slot
+    is taken, so its paging time limit starts when the wallet's work starts, while time
+    spent queued counts against the request deadline.
+
+    A request whose deadline passes while it is queued runs without a slot: past its
+    deadline it makes no Moralis calls and only reads cached pages.
+    """
+    if queued_at is None:
+        queued_at = time.monotonic()
+    deadline_seconds = budget_limits[2]
+    if deadline_seconds is not None:
+        deadline_seconds = max(deadline_seconds - (time.monotonic() - queued_at), 0)
+    has_slot = extraction_slots.acquire(lane, deadline_seconds)
+    try:
+        yield queued_budget(budget_limits, lane, queued_at)
+    finally:
+        if has_slot:
+            extraction_slots.release(lane)
+
+def compute_wallet(wallet_address, budget_limits, features=None, lane=INTERACTIVE, queued_at=None):
+    """
+    Run the feature pipeline for one wallet in the given priority lane. queued_at is
+    when the request started waiting, if before now.
+    """
+    with extraction_budget(budget_limits, lane, queued_at) as budget:
+        wallet_data = WalletData(wallet_address, budget=budget)
+        try:
+            # Calculate features using your pipeline
+            feature_values = calculate_all_features(wallet_address, wallet_data, features)
+            return finish_response(wallet_address, wallet_data, feature_values, features)
+        finally:
+            wallet_data.close()
+
+def extract_wallet_or_error(wallet_address, budget_limits, refresh=False, features=None, lane=BATCH):
+    if not is_valid_address(wallet_address):
+        return {"walletAddress": wallet_address, "error": INVALID_ADDRESS_ERROR}
+    try:
+        return extract_wallet(wallet_address, budget_limits, refresh, features, lane)
+    except CircuitOpen as e:
+        return {"walletAddress": wallet_address, "error": str(e), "retryAfter": math.ceil(e.retry_after)}
+    except Exception as e:
+        return {"walletAddress": wallet_address, "error": str(e)}
+
 @app.route('/extract-features', methods=['POST'])
 def extract_features_endpoint():
-    data = request.get_json()
-    if not data or "walletAddress" not in data:
-        return jsonify({"error": "Missing walletAddress in request body"}), 400
+    parsed, error = parse_wallet_request(request.get_json(), request.headers, INTERACTIVE)
+    if error:
+        return jsonify({"error": error}), 400
+    wallet_address, budget_limits, features, lane, refresh = parsed
 
-    wallet_address = data["walletAddress"]
     try:
-        # Calculate features using your pipeline
-        features = calculate_all_features(wallet_address)
-        # Build a JSON response that includes the wallet address and the features
-        response = {
-            "walletAddress": wallet_address,
-            "features": features
-        }
-        return jsonify(response), 200
+        return jsonify(extract_wallet(wallet_address, budget_limits, refresh, features, lane)), 200
+    except CircuitOpen as e:
+        # Shed load while Moralis is degraded rather than queueing on it
+        retry_after = math.ceil(e.retry_after)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(retry_after)}
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/extract-features/jobs', methods=['POST'])
+def submit_extraction_job_endpoint():
+    """
+    Queue an extraction and answer immediately with its job id. Takes the same body as
+    /extract-features; poll GET /extract-features/jobs/<job_id> for the result.
+    """
+    parsed, error = parse_wallet_request(request.get_json(), request.headers, BACKGROUND)
+    if error:
+        return jsonify({"error": error}), 400
+    wallet_address, budget_limits, features, lane, refresh = parsed
+
+    job = job_queue.submit(extract_wallet, wallet_address, budget_limits, refresh, features, lane, lane=lane)
+    status_url = f"/extract-features/jobs/{job['jobId']}"
+    return jsonify({**job, "statusUrl": status_url}), 202, {"Location": status_url}
+
+@app.route('/extract-features/jobs/<job_id>', methods=['GET'])
+def extraction_job_status_endpoint(job_id):
+    """
+    Return a job's status, and its result once done. ?wait=<seconds> long-polls until the
+    job finishes or the wait (capped at JOB_MAX_WAIT) runs out.
+    """
+    try:
+        wait = float(request.args.get("wait", 0))
+    except ValueError:
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+
+    job = job_queue.get(job_id, wait)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    return jsonify(job), 200
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def events_request_data():
+    """
+    Read an events request from the JSON body (POST) or the query string (GET, for
+    EventSource clients), where features is comma-separated and refresh is "true".
+    """
+    if request.method == 'POST':
+        return request.get_json()
+    data = request.args.to_dict()
+    if "features" in data:
+        data["features"] = [name.strip() for name in data["features"].split(",") if name.strip()]
+    data["refresh"] = data.get("refresh", "").lower() == "true"
+    return data
+
+def group_event(group, values, wallet_data):
+    """
+    Build the event for one computed group, flagging its incomplete features.
+    """
+    event = {"group": group, "features": values}
+    add_incomplete_flags(event, wallet_data, list(values))
+    split_pending(event, wallet_data, list(values))
+    return event
+
+@app.route('/extract-features/events', methods=['GET', 'POST'])
+def extract_features_events_endpoint():
+    """
+    Server-sent events version of /extract-features. A "group" event is sent as soon as
+    each feature group is computed, so cheap groups are not held back by long
+    paginations, then a "complete" event with the full response entry, or an "error" event.
+    """
+    data = events_request_data()
+    if not data or "walletAddress" not in data:
+        return jsonify({"error": "Missing walletAddress in request"}), 400
+
+    wallet_address = data["walletAddress"]
+    if not is_valid_address(wallet_address):
+        return jsonify({"error": INVALID_ADDRESS_ERROR}), 400
+    try:
+        budget_limits = parse_budget_limits(data, request.headers)
+    except (TypeError, ValueError):
+        return jsonify({"error": INVALID_LIMITS_ERROR}), 400
+    try:
+        features = parse_features(data)
+        lane = parse_lane(data, request.headers, INTERACTIVE)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        cached = cached_response(wallet_address, wants_refresh(data, request.headers), features)
+    except CircuitOpen as e:
+        retry_after = math.ceil(e.retry_after)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(retry_after)}
+
+    def replay_cached():
+        for group, names in FEATURE_GROUPS.items():
+            values = {name: cached["features"][name] for name in names if name in cached["features"]}
+            if values:
+                yield sse_event("group", {"group": group, "features": values})
+        yield sse_event("complete", cached)
+
+    def generate():
+        with extraction_budget(budget_limits, lane) as budget:
+            wallet_data = WalletData(wallet_address, budget=budget)
+            try:
+                group_values = {}
+                for group, values in iter_feature_groups(wallet_address, wallet_data, features):
+                    group_values[group] = values
+                    yield sse_event("group", group_event(group, values, wallet_data))
+                # Assemble the groups in the order calculate_all_features builds them. Not
+                # every requested feature is present: wallets without DeFi positions have
+                # no AverageAPY, as in the synchronous response.
+                feature_values = {}
+                for group in FEATURE_GROUP_BUILDERS:
+                    feature_values.update(group_values.get(group, {}))
+                response = finish_response(wallet_address, wallet_data, feature_values, features)
+                yield sse_event("complete", {**response, "cached": False, "cacheAgeSeconds": 0})
+            except Exception as e:
+                yield sse_event("error", {"walletAddress": wallet_address, "error": str(e)})
+            finally:
+                wallet_data.close()
+
+    stream = replay_cached() if cached is not None else generate()
+    # Ask proxies not to buffer the stream, or groups would arrive all at once
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(stream), mimetype="text/event-stream", headers=headers)
+
+def parse_wallet_list(data, max_wallets):
+    """
+    Validate a multi-wallet request body.
+
+    Returns:
+        tuple: (wallet_addresses, budget_limits, features, None) on success, or
+        (None, None, None, error response).
+    """
+    if not data or not isinstance(data.get("walletAddresses"), list):
+        return None, None, None, (jsonify({"error": "Missing walletAddresses list in request body"}), 400)
+
+    wallet_addresses = data["walletAddresses"]
+    if len(wallet_addresses) > max_wallets:
+        return None, None, None, (jsonify({"error": f"At most {max_wallets} wallets per request"}), 400)
+    try:
+        budget_limits = parse_budget_limits(data, request.headers)
+    except (TypeError, ValueError):
+        return None, None, None, (jsonify({"error": INVALID_LIMITS_ERROR}), 400)
+    try:
+        features = parse_features(data)
+    except ValueError as e:
+        return None, None, None, (jsonify({"error": str(e)}), 400)
+    return wallet_addresses, budget_limits, features, None
+
+@app.route('/extract-features/batch', methods=['POST'])
+def extract_features_batch_endpoint():
+    data = request.get_json()
+    wallet_addresses, budget_limits, features, error = parse_wallet_list(data, BATCH_MAX_WALLETS)
+    if error:
+        return error
+    try:
+        lane = parse_lane(data, request.headers, BATCH)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    refresh = wants_refresh(data, request.headers)
+
+    # Wallets run with bounded concurrency and share the Moralis connection pool and caches;
+    # a failure is reported in that wallet's entry instead of failing the whole batch
+    futures = [
+        batch_executor.submit(lane, extract_wallet_or_error, wallet_address, budget_limits, refresh, features, lane)
+        for wallet_address in wallet_addresses
+    ]
+    results = [future.result() for future in futures]
+    return jsonify({"results": results}), 200
+
+@app.route('/extract-features/stream', methods=['POST'])
+def extract_features_stream_endpoint():
+    data = request.get_json()
+    wallet_addresses, budget_limits, features, error = parse_wallet_list(data, STREAM_MAX_WALLETS)
+    if error:
+        return error
+    try:
+        lane = parse_lane(data, request.headers, BATCH)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    refresh = wants_refresh(data, request.headers)
+
+    futures = [
+        batch_executor.submit(lane, extract_wallet_or_error, wallet_address, budget_limits, refresh, features, lane)
+        for wallet_address in wallet_addresses
+    ]
+
+    def generate():
+        # One JSON object per line, in completion order, so clients can start scoring
+        # while the rest of the wallets are still being extracted
+        try:
+            for future in as_completed(futures):
+                yield json.dumps(future.result()) + "\n"
+        finally:
+            # Client went away or the stream ended: drop wallets that have not started yet
+            for future in futures:
+                future.cancel()
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.route('/lanes', methods=['GET'])
+def lanes_endpoint():
+    """
+    Queue depth, throughput and usage of each priority lane, for the Moralis compute-unit
+    scheduler and the extraction worker slots of this process.
+    """
+    return jsonify({"moralis": scheduler.stats(), "workers": extraction_slots.stats()}), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Request, extraction, feature group, Moralis call and cache metrics of this process,
+    in the Prometheus text format.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == '__main__':
     # Run the Flask app on port 8001
     app.run(host='0.0.0.0', port=8001, debug=True)
\ No newline at end of file
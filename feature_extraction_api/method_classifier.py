@@ -0,0 +1,101 @@
+"""
+Classification of decoded contract calls into the WALLET_METHODS_* categories.
+
+The method lists are compiled once into a single regex (liquidations), a joined
+haystack (repayments) and a set (DeFi history), and each distinct label is classified
+once and memoized. Matching is applied to the lowercased label exactly as the original
+per-transaction checks did:
+
+- liquidate: any WALLET_METHODS_LIQUIDATE entry is a substring of the label
+- repay: the label is a substring of some WALLET_METHODS_REPAY entry (so an empty label matches)
+- history: the label equals a WALLET_METHODS_HISTORY entry
+
+Because the label is lowercased first, mixed-case entries such as "liquidationCall" can
+never match; they are kept in the lists but have no effect.
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# Wallet methods indicating repayments, liquidate and other interactions
+WALLET_METHODS_REPAY = [
+    # General Repayment Methods
+    "repay", "repayborrow", "repayWithPermit", "repayBorrowBehalf",
+    "paybackDebt", "burnSynths", "repayDebt", "repayLoan", "repayTroves",
+
+    # Specific Protocols
+    "repayStableDebt", "repayVariableDebt",  # Aave
+    "repayFor",  # Some custom implementations
+    "repayCollateralizedDebt",  # Compound-like protocols
+]
+
+WALLET_METHODS_LIQUIDATE = [
+    # General Liquidation Methods
+    "liquidationCall", "liquidateBorrow", "liquidate",
+    "liquidateDelinquentAccount", "liquidateTroves", "liquidatePosition",
+
+    # Specific to MakerDAO
+    "bite",
+
+    # Liquity
+    "redeemCollateral", "adjustTrove", "closeTrove",
+
+    # Venus Protocol
+    "seize",
+
+    # Alpha Homora
+    "forceClosePosition",
+
+    # SushiSwap/Kashi
+    "liquidateAccount",
+]
+
+WALLET_METHODS_HISTORY = [
+    "deposit", "supply", "withdraw", "borrow", "repay", "repayborrow", "flashLoan", "flash",
+    "swapBorrowRateMode", "setUserUseReserveAsCollateral", "configureReserveAsCollateral",
+    "setCollateralConfiguration", "approveDelegation", "delegateCredit", "lockCollateral",
+    "freeCollateral", "enterMarkets", "exitMarket", "mint", "redeem", "redeemUnderlying",
+    "increaseAllowance", "repayWithPermit", "liquidationCall", "liquidateBorrow", "liquidate",
+    "repayBorrowBehalf", "generateDebt", "paybackDebt", "swap", "swapExactTokensForTokens",
+    "flashMint", "collateralSwap", "addLiquidity", "removeLiquidity"
+]
+
+MethodCategories = namedtuple("MethodCategories", ["liquidate", "repay", "history"])
+
+NO_CATEGORIES = MethodCategories(False, False, False)
+
+_LIQUIDATE_PATTERN = re.compile("|".join(
+    re.escape(method) for method in sorted(set(WALLET_METHODS_LIQUIDATE), key=len, reverse=True)
+))
+_REPAY_SEPARATOR = "\x00"
+_REPAY_HAYSTACK = _REPAY_SEPARATOR.join(WALLET_METHODS_REPAY)
+_HISTORY_METHODS = frozenset(WALLET_METHODS_HISTORY)
+
+
+@lru_cache(maxsize=4096)
+def classify_label(label):
+    """
+    Classify a decoded_call label into its liquidate/repay/history categories.
+
+    Args:
+        label (str): Raw decoded_call label (any case).
+
+    Returns:
+        MethodCategories: Which categories the label belongs to.
+    """
+    method = label.lower()
+    return MethodCategories(
+        liquidate=_LIQUIDATE_PATTERN.search(method) is not None,
+        repay=_REPAY_SEPARATOR not in method and method in _REPAY_HAYSTACK,
+        history=method in _HISTORY_METHODS,
+    )
+
+
+def classify_decoded_call(decoded_call):
+    """
+    Classify a transaction's decoded_call. Anything that is not a dict (a missing or
+    undecoded call) belongs to no category.
+    """
+    if not isinstance(decoded_call, dict):
+        return NO_CATEGORIES
+    return classify_label(decoded_call.get("label", ""))
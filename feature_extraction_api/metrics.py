@@ -0,0 +1,175 @@
+"""
+In-process metrics exposed in the Prometheus text format by the /metrics endpoint.
+
+Recording a sample only takes a short lock and a dict update: label values are passed
+positionally and used as the dict key, and histograms keep plain bucket counts that are
+made cumulative when scraped. Nothing is formatted until the endpoint is read. Every
+worker process keeps its own metrics, so scrape each worker (e.g. one port per
+process) to see the whole server.
+"""
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Upper bounds of the per-extraction page count buckets
+PAGE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _samples(self):
+        """
+        Return (name suffix, label values, extra label, value) tuples for the exposition.
+        """
+        with self._lock:
+            return [("", labels, None, value) for labels, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labels, labels, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count, one per combination of label values.
+    """
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Value that goes up and down, such as the number of requests in flight.
+    """
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values over fixed buckets, with their count and sum.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # One count per bucket plus the +Inf bucket, then the sum
+                entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def _samples(self):
+        with self._lock:
+            entries = [(labels, list(entry)) for labels, entry in sorted(self._values.items())]
+        samples = []
+        for labels, entry in entries:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), entry[:-1]):
+                cumulative += count
+                samples.append(("_bucket", labels, ("le", _format_value(bound)), cumulative))
+            samples.append(("_sum", labels, None, entry[-1]))
+            samples.append(("_count", labels, None, cumulative))
+        return samples
+
+
+def render():
+    """
+    Return every registered metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+http_requests_in_flight = Gauge(
+    "http_requests_in_flight", "Requests being served, by route.", ("route",)
+)
+http_requests = Counter(
+    "http_requests_total", "Requests answered, by route and status code.", ("route", "status")
+)
+http_request_seconds = Histogram(
+    "http_request_seconds", "Time to answer a request, by route.", ("route",)
+)
+extraction_queue_seconds = Histogram(
+    "extraction_queue_seconds", "Time an extraction waited for a worker slot, by lane.", ("lane",)
+)
+extraction_seconds = Histogram(
+    "extraction_seconds", "Time to compute a wallet's features once it had a worker slot, by lane.", ("lane",)
+)
+extraction_pages = Histogram(
+    "extraction_pages", "Moralis pages fetched from the network per extraction, by lane.", ("lane",),
+    buckets=PAGE_BUCKETS,
+)
+feature_group_seconds = Histogram(
+    "feature_group_seconds", "Time from the start of an extraction until a feature group was built.", ("group",)
+)
+moralis_request_seconds = Histogram(
+    "moralis_request_seconds", "Duration of each HTTP call to Moralis, by endpoint.", ("endpoint",)
+)
+moralis_requests = Counter(
+    "moralis_requests_total", "HTTP calls to Moralis, by endpoint and status code (error if none).",
+    ("endpoint", "status"),
+)
+moralis_retries = Counter(
+    "moralis_retries_total", "Moralis calls retried after a retryable error, by endpoint.", ("endpoint",)
+)
+moralis_errors = Counter(
+    "moralis_errors_total", "Moralis calls that failed after retries, by endpoint.", ("endpoint",)
+)
+moralis_circuit_open = Counter(
+    "moralis_circuit_open_total", "Moralis calls refused by an open circuit breaker, by endpoint.", ("endpoint",)
+)
+cache_lookups = Counter(
+    "cache_lookups_total", "Cache lookups by cache (pages, results) and result (hit, stale, miss).",
+    ("cache", "result"),
+)
@@ -0,0 +1,578 @@
+"""
+Shared HTTP client for the Moralis Web3 Data API.
+
+Every Moralis request goes through one pooled requests.Session, so connections (and
+their TLS sessions) are kept alive and reused across pages, wallets and threads
+instead of being opened per call.
+
+The policy of a call (budget admission, timeouts, breaker outcome, retries and the page
+cache) and of multi-call fetches lives here as plain functions and walks, and is shared
+with the asyncio client in async_moralis_client.py, which only differs in how it waits
+and makes the HTTP call. A walk is a generator holding the logic of a fetch that takes
+several calls (paging, history sync): it yields (endpoint, params, count_page)
+requests, receives each response, or the error raised by the call, and returns its
+result. run_walk makes the calls a walk asks for.
+"""
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import page_cache
+from circuit_breaker import CircuitOpen, get_breaker
+from lanes import DEFAULT_LANE
+from rate_limiter import parse_retry_after, scheduler
+
+MORALIS_BASE_URL = os.environ.get("MORALIS_BASE_URL", "https://deep-index.moralis.io/api/v2.2")
+
+# Connection pool sizing: number of per-host pools kept, and connections kept alive per host
+MORALIS_POOL_CONNECTIONS = int(os.environ.get("MORALIS_POOL_CONNECTIONS", 4))
+MORALIS_POOL_MAXSIZE = int(os.environ.get("MORALIS_POOL_MAXSIZE", 32))
+
+# Timeouts in seconds for establishing a connection and for waiting on a response
+MORALIS_CONNECT_TIMEOUT = float(os.environ.get("MORALIS_CONNECT_TIMEOUT", 5))
+MORALIS_READ_TIMEOUT = float(os.environ.get("MORALIS_READ_TIMEOUT", 30))
+
+# Retries of a failed call (timeouts, connection errors, 429 and 5xx responses) with
+# jittered exponential backoff between attempts
+MORALIS_MAX_RETRIES = int(os.environ.get("MORALIS_MAX_RETRIES", 4))
+MORALIS_BACKOFF_BASE = float(os.environ.get("MORALIS_BACKOFF_BASE", 0.5))
+MORALIS_BACKOFF_MAX = float(os.environ.get("MORALIS_BACKOFF_MAX", 20))
+
+# Moralis endpoints used by the feature pipeline, keyed by name
+ENDPOINTS = {
+    "wallet_history": "/wallets/{address}/history",
+    "wallet_transactions_verbose": "/{address}/verbose",
+    "defi_positions_summary": "/wallets/{address}/defi/positions",
+    "wallet_net_worth": "/wallets/{address}/net-worth",
+    "wallet_swaps": "/wallets/{address}/swaps",
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class BudgetExhausted(Exception):
+    """Raised instead of making a Moralis call once a FetchBudget has run out."""
+
+
+class FetchBudget:
+    """
+    Page and time allowance shared by the paginated Moralis listings fetched for one wallet.
+
+    Only pages fetched from the network count against the page limit; pages served from
+    the page cache are free. An optional request deadline bounds every call made with
+    the budget, single calls included: calls are refused once it has passed, and their
+    timeouts, retries and rate-limit waits are capped to the time left. Endpoints whose pagination was cut short are recorded in
+    `truncated`, endpoints whose first page could not be fetched at all in `skipped`,
+    endpoints whose paging ended on an error in `failed`, and endpoints answered from
+    expired cache entries while their circuit breaker was open in `stale`. Calls are
+    scheduled in the budget's priority lane.
+    """
+
+    def __init__(self, max_pages=None, max_seconds=None, deadline_seconds=None, lane=DEFAULT_LANE):
+        now = time.monotonic()
+        self.started = now
+        self.max_pages = max_pages
+        self.lane = lane
+        self.request_deadline = now + deadline_seconds if deadline_seconds is not None else None
+        # Paging stops at whichever of the paging time limit and the request deadline comes first
+        paging_deadline = now + max_seconds if max_seconds is not None else None
+        deadlines = [d for d in (paging_deadline, self.request_deadline) if d is not None]
+        self.deadline = min(deadlines) if deadlines else None
+        self.pages = 0
+        self.truncated = set()
+        self.skipped = set()
+        self.failed = set()
+        self.stale = set()
+        self._lock = threading.Lock()
+
+    def exhausted(self):
+        if self.max_pages is not None and self.pages >= self.max_pages:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self):
+        """
+        Seconds left before the request deadline, or None if the request has no deadline.
+        """
+        if self.request_deadline is None:
+            return None
+        return max(0.0, self.request_deadline - time.monotonic())
+
+    def deadline_exceeded(self):
+        return self.request_deadline is not None and time.monotonic() >= self.request_deadline
+
+    def check_deadline(self, endpoint):
+        """
+        Raise BudgetExhausted if the request deadline has passed. Used for single calls,
+        which do not count against the page limit.
+        """
+        if self.deadline_exceeded():
+            raise BudgetExhausted(f"Request deadline passed before {endpoint}")
+
+    def take_page(self, endpoint):
+        """
+        Reserve one call, or record the endpoint as skipped and raise BudgetExhausted.
+        """
+        with self._lock:
+            if self.exhausted():
+                self.skipped.add(endpoint)
+                raise BudgetExhausted(f"Fetch budget exhausted after {self.pages} pages")
+            self.pages += 1
+
+    def mark_skipped(self, endpoint):
+        with self._lock:
+            self.skipped.add(endpoint)
+
+    def mark_truncated(self, endpoint):
+        with self._lock:
+            self.skipped.discard(endpoint)
+            self.truncated.add(endpoint)
+
+    def mark_failed(self, endpoint):
+        with self._lock:
+            self.failed.add(endpoint)
+
+    def mark_stale(self, endpoint):
+        with self._lock:
+            self.stale.add(endpoint)
+
+
+def get_session():
+    """
+    Return the process-wide Moralis session, creating it on first use.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=MORALIS_POOL_CONNECTIONS, pool_maxsize=MORALIS_POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                "Accept": "application/json",
+                "X-API-Key": os.environ.get("API_KEY", ""),
+            })
+            _session = session
+        return _session
+
+
+def read_timeout_for(endpoint):
+    """
+    Return the read timeout for an endpoint: MORALIS_READ_TIMEOUT_<ENDPOINT> if set
+    (for example MORALIS_READ_TIMEOUT_WALLET_HISTORY), otherwise MORALIS_READ_TIMEOUT.
+    """
+    return float(os.environ.get(f"MORALIS_READ_TIMEOUT_{endpoint.upper()}", MORALIS_READ_TIMEOUT))
+
+
+def is_retryable(error):
+    """
+    Check whether a failed call is worth repeating: network errors, throttling and server errors.
+    """
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def backoff_delay(attempt, error=None):
+    """
+    Full-jitter exponential backoff, never shorter than a Retry-After sent with the error.
+    """
+    delay = random.uniform(0, min(MORALIS_BACKOFF_MAX, MORALIS_BACKOFF_BASE * 2 ** attempt))
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+    return delay
+
+
+def encode_params(params):
+    """
+    Encode query parameters the way the Moralis API expects them.
+
+    Lists become indexed keys (chains[0]=eth) and booleans are lowercased.
+    """
+    encoded = {}
+    for key, value in (params or {}).items():
+        if isinstance(value, (list, tuple)):
+            for index, item in enumerate(value):
+                encoded[f"{key}[{index}]"] = item
+        elif isinstance(value, bool):
+            encoded[key] = "true" if value else "false"
+        elif value is not None:
+            encoded[key] = value
+    return encoded
+
+
+def admit_call(endpoint, budget, count_page):
+    """
+    Let a call through the endpoint's circuit breaker and charge it to the budget.
+
+    The breaker is only checked here: the call claims a half-open probe in recorded_call,
+    once the budget and the rate scheduler have let it through.
+
+    Returns:
+        tuple: (breaker, time after which a retry would be cut short, or None).
+    """
+    breaker = get_breaker(endpoint)
+    breaker.check()
+    give_up_at = None
+    if budget is not None:
+        if count_page:
+            budget.take_page(endpoint)
+            give_up_at = budget.deadline
+        else:
+            budget.check_deadline(endpoint)
+            give_up_at = budget.request_deadline
+    return breaker, give_up_at
+
+
+def scheduler_wait(budget):
+    """
+    Return the keyword arguments of the rate scheduler wait for a call made with the budget.
+    """
+    if budget is None:
+        return {"max_wait": None, "lane": DEFAULT_LANE}
+    return {"max_wait": budget.remaining(), "lane": budget.lane}
+
+
+def refused_by_scheduler(endpoint, budget, count_page):
+    """
+    Record a call the rate scheduler could not fit in before the request deadline, and
+    return the error to raise for it.
+    """
+    if count_page:
+        budget.mark_skipped(endpoint)
+    return BudgetExhausted(f"Request deadline would pass while waiting to call {endpoint}")
+
+
+def call_timeouts(endpoint, budget):
+    """
+    Return the (connect, read) timeouts of a call, capped to the time left before the
+    budget's request deadline.
+    """
+    connect_timeout, read_timeout = MORALIS_CONNECT_TIMEOUT, read_timeout_for(endpoint)
+    if budget is not None and budget.request_deadline is not None:
+        remaining = max(0.1, budget.remaining())
+        connect_timeout, read_timeout = min(connect_timeout, remaining), min(read_timeout, remaining)
+    return connect_timeout, read_timeout
+
+
+class CallOutcome:
+    """
+    Outcome of one HTTP call, filled in by the client that makes it.
+    """
+
+    def __init__(self):
+        self.succeeded = None
+        self.status = "error"
+
+    def responded(self, response):
+        # Throttling is handled by the rate scheduler; only timeouts, connection errors
+        # and server errors count against the breaker
+        self.succeeded = response.status_code < 500
+        self.status = str(response.status_code)
+        if response.status_code == 429:
+            scheduler.on_throttled(parse_retry_after(response.headers.get("Retry-After")))
+        else:
+            scheduler.on_success()
+
+
+@contextmanager
+def recorded_call(endpoint, breaker, transport_errors):
+    """
+    Claim the breaker for one HTTP call and record its outcome on the breaker and in the
+    metrics. The call reports its response with CallOutcome.responded; raising one of
+    transport_errors (the HTTP library's errors) counts as a failure.
+    """
+    breaker.before_call()
+    outcome = CallOutcome()
+    started = time.monotonic()
+    try:
+        yield outcome
+    except transport_errors:
+        if outcome.succeeded is None:
+            outcome.succeeded = False
+        raise
+    finally:
+        # A call that ended without an outcome (cancelled, or an unexpected error)
+        # releases the probe instead of leaving the breaker half-open for good
+        if outcome.succeeded is None:
+            breaker.release()
+        else:
+            breaker.record(outcome.succeeded)
+        metrics.moralis_request_seconds.observe(time.monotonic() - started, endpoint)
+        metrics.moralis_requests.inc(endpoint, outcome.status)
+
+
+def retry_delay(endpoint, attempt, error, retryable, give_up_at):
+    """
+    Decide whether a failed call is tried again.
+
+    Returns:
+        float | None: Seconds to wait before the next attempt, or None to give up.
+    """
+    if attempt >= MORALIS_MAX_RETRIES or not retryable:
+        metrics.moralis_errors.inc(endpoint)
+        return None
+    delay = backoff_delay(attempt, error)
+    # Waiting past the budget deadline would only be cut short, so fail now
+    if give_up_at is not None and time.monotonic() + delay >= give_up_at:
+        metrics.moralis_errors.inc(endpoint)
+        return None
+    metrics.moralis_retries.inc(endpoint)
+    print(f"Retrying {endpoint} in {delay:.1f}s after error: {error}")
+    return delay
+
+
+def cached_page(endpoint, wallet_address, params):
+    """
+    Return the fresh cached response for a call, or None, counting the lookup.
+    """
+    cached = page_cache.get(endpoint, wallet_address, params)
+    metrics.cache_lookups.inc("pages", "miss" if cached is None else "hit")
+    return cached
+
+
+def stale_page(endpoint, wallet_address, params, budget, use_cache):
+    """
+    Return the expired cached response answering a call refused by an open circuit
+    breaker, recording it as stale on the budget, or None if there is none.
+    """
+    metrics.moralis_circuit_open.inc(endpoint)
+    stale = page_cache.get(endpoint, wallet_address, params, allow_stale=True) if use_cache else None
+    if stale is not None:
+        metrics.cache_lookups.inc("pages", "stale")
+        if budget is not None:
+            budget.mark_stale(endpoint)
+    return stale
+
+
+def _fetch(endpoint, wallet_address, params, budget, count_page):
+    """
+    Make one Moralis call through the circuit breaker, rate scheduler and retry loop.
+    """
+    breaker, give_up_at = admit_call(endpoint, budget, count_page)
+    url = MORALIS_BASE_URL + ENDPOINTS[endpoint].format(address=wallet_address)
+    attempt = 0
+    while True:
+        try:
+            if scheduler.acquire(endpoint, **scheduler_wait(budget)) is None:
+                raise refused_by_scheduler(endpoint, budget, count_page)
+            connect_timeout, read_timeout = call_timeouts(endpoint, budget)
+            with recorded_call(endpoint, breaker, requests.exceptions.RequestException) as outcome:
+                response = get_session().get(
+                    url,
+                    params=encode_params(params),
+                    timeout=(connect_timeout, read_timeout),
+                )
+                outcome.responded(response)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            delay = retry_delay(endpoint, attempt, e, is_retryable(e), give_up_at)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+
+def moralis_get(endpoint, wallet_address, params=None, use_cache=True, budget=None, count_page=True):
+    """
+    Call a Moralis endpoint for a wallet through the shared session.
+
+    Fresh responses in the on-disk page cache are returned without a network call,
+    and successful responses are written back to it. Network calls first wait for their
+    compute units from the process-wide rate scheduler, which slows down on 429s.
+    Retryable failures are repeated with backoff up to MORALIS_MAX_RETRIES times; since
+    the params carry the pagination cursor, a retried page resumes where paging stopped.
+    While the endpoint's circuit breaker is open no call is made: an expired cached
+    response is returned if there is one, otherwise CircuitOpen is raised.
+
+    Args:
+        endpoint (str): Key into ENDPOINTS.
+        wallet_address (str): Wallet address substituted into the endpoint path.
+        params (dict, optional): Query parameters, including the pagination cursor.
+        use_cache (bool): Whether to read from and write to the page cache.
+        budget (FetchBudget, optional): Allowance charged for the call if it goes to the network.
+        count_page (bool): Whether the call counts against the budget's page limit; single
+            calls only observe its request deadline.
+
+    Returns:
+        dict | list: Decoded JSON response.
+
+    Raises:
+        BudgetExhausted: The budget ran out or the request deadline passed before the call.
+        CircuitOpen: The endpoint's circuit breaker is open and nothing is cached.
+        requests.exceptions.RequestException: The call failed and could not be retried
+            (retries exhausted, not retryable, or no time left before the budget deadline).
+    """
+    if use_cache:
+        cached = cached_page(endpoint, wallet_address, params)
+        if cached is not None:
+            return cached
+
+    try:
+        body = _fetch(endpoint, wallet_address, params, budget, count_page)
+    except CircuitOpen:
+        stale = stale_page(endpoint, wallet_address, params, budget, use_cache)
+        if stale is None:
+            raise
+        return stale
+    if use_cache:
+        page_cache.put(endpoint, wallet_address, params, body)
+    return body
+
+
+def end_paging(endpoint, params, budget, error):
+    """
+    Record why paging an endpoint stopped on an error. Running out of budget after the
+    first page leaves the endpoint truncated; any other error is reported and recorded
+    as a failure.
+    """
+    if isinstance(error, BudgetExhausted):
+        if "cursor" in params:
+            budget.mark_truncated(endpoint)
+        return
+    print(f"Error fetching {endpoint} page: {error}")
+    if budget is not None:
+        budget.mark_failed(endpoint)
+
+
+def step_walk(walk, result=None, error=None):
+    """
+    Resume a walk with the response to its last request, or the error the call raised.
+
+    Returns:
+        tuple: (done, the walk's next request, or its result once done).
+    """
+    try:
+        return False, walk.throw(error) if error is not None else walk.send(result)
+    except StopIteration as stop:
+        return True, stop.value
+
+
+def run_walk(walk, wallet_address, budget=None):
+    """
+    Make the Moralis calls a walk asks for, in order, and return its result.
+    """
+    done, value = step_walk(walk)
+    while not done:
+        endpoint, params, count_page = value
+        try:
+            result = moralis_get(endpoint, wallet_address, params, budget=budget, count_page=count_page)
+        except Exception as e:
+            done, value = step_walk(walk, error=e)
+        else:
+            done, value = step_walk(walk, result)
+    return value
+
+
+def single_call_walk(endpoint, params, parse, default, source, budget=None):
+    """
+    Walk making one call that only observes the request deadline, returning its parsed
+    response. A failure is reported, recorded on the budget under source and answered
+    with default.
+    """
+    try:
+        result = yield endpoint, params, False
+        return parse(result)
+    except Exception as e:
+        print(f"Error fetching {source}: {e}")
+        if budget is not None:
+            budget.mark_failed(source)
+        return default
+
+
+def paged_walk(endpoint, params, on_page, budget=None):
+    """
+    Walk following the cursors of a paginated endpoint, passing the items of each page to
+    on_page until it returns True or the pages run out. Errors end it as in iter_pages.
+
+    Returns:
+        bool: Whether paging ended without an error.
+    """
+    params = dict(params or {})
+    while True:
+        try:
+            result = yield endpoint, dict(params), True
+        except Exception as e:
+            end_paging(endpoint, params, budget, e)
+            return False
+        cursor = result.get("cursor")
+        if on_page(result.get("result", [])) or not cursor:
+            return True
+        params["cursor"] = cursor
+
+
+def first_match_walk(endpoint, params, predicate, budget=None):
+    """
+    Walk returning the first item matching predicate, stopping pagination as soon as it is found.
+    """
+    matches = []
+
+    def match(page):
+        matches.extend(item for item in page if predicate(item))
+        return bool(matches)
+
+    yield from paged_walk(endpoint, params, match, budget)
+    return matches[0] if matches else None
+
+
+def iter_pages(endpoint, wallet_address, params=None, budget=None):
+    """
+    Yield the result list of each page of a paginated Moralis endpoint, following cursors.
+
+    Pages are fetched lazily, so a consumer that stops iterating (for example once the
+    answer it needs is known) stops further API calls. An error that persists after
+    moralis_get's retries ends the iteration after being reported and recorded on the
+    budget, leaving the pages already yielded to the caller. Running out of budget ends
+    it quietly and records the endpoint as truncated.
+
+    Args:
+        endpoint (str): Key into ENDPOINTS.
+        wallet_address (str): Wallet address substituted into the endpoint path.
+        params (dict, optional): Query parameters for the first page.
+        budget (FetchBudget, optional): Allowance shared with the wallet's other calls.
+
+    Yields:
+        list: Items of one page.
+    """
+    params = dict(params or {})
+    while True:
+        try:
+            result = moralis_get(endpoint, wallet_address, params, budget=budget)
+        except Exception as e:
+            end_paging(endpoint, params, budget, e)
+            return
+
+        yield result.get("result", [])
+
+        cursor = result.get("cursor")
+        if not cursor:
+            return
+        params["cursor"] = cursor
+
+
+def iter_items(endpoint, wallet_address, params=None, budget=None):
+    """
+    Yield the individual items of a paginated Moralis endpoint, one page at a time.
+    """
+    for page in iter_pages(endpoint, wallet_address, params, budget):
+        yield from page
+
+
+def find_first(endpoint, wallet_address, params, predicate, budget=None):
+    """
+    Return the first item matching predicate, stopping pagination as soon as it is found.
+    """
+    return run_walk(first_match_walk(endpoint, params, predicate, budget), wallet_address, budget)
@@ -0,0 +1,151 @@
+"""
+On-disk cache of raw Moralis responses.
+
+Responses are stored in SQLite keyed by endpoint, wallet, query parameters and
+pagination cursor, so repeated extractions for a known wallet are served locally.
+The cache file lives next to this module by default, which lets the feature API and
+the dataset collection pipeline share it.
+
+Expired responses are kept for PAGE_CACHE_STALE_TTL more seconds, so they can be
+served as stale while Moralis is unavailable, and then deleted. Writers prune them at
+most once every PAGE_CACHE_PRUNE_INTERVAL seconds.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Set PAGE_CACHE_PATH to an empty string to disable the cache
+PAGE_CACHE_PATH = os.environ.get(
+    "PAGE_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "moralis_pages.sqlite3"),
+)
+
+# Seconds a cached response stays fresh. Positions and net worth move with prices, so
+# they go stale quickly. The first page of a paginated listing changes as new activity
+# arrives, while pages reached through a cursor are historical and effectively immutable.
+SNAPSHOT_TTL = int(os.environ.get("PAGE_CACHE_SNAPSHOT_TTL", 300))
+HEAD_PAGE_TTL = int(os.environ.get("PAGE_CACHE_HEAD_PAGE_TTL", 600))
+HISTORICAL_PAGE_TTL = int(os.environ.get("PAGE_CACHE_HISTORICAL_PAGE_TTL", 30 * 24 * 3600))
+# Seconds an expired response is kept to be served as stale while Moralis is unavailable
+STALE_TTL = int(os.environ.get("PAGE_CACHE_STALE_TTL", 86400))
+# Seconds between deletions of responses past their stale window
+PRUNE_INTERVAL = int(os.environ.get("PAGE_CACHE_PRUNE_INTERVAL", 3600))
+
+PAGINATED_ENDPOINTS = {"wallet_history", "wallet_transactions_verbose", "wallet_swaps"}
+
+_local = threading.local()
+_prune_lock = threading.Lock()
+_pruned_at = 0.0
+
+
+def _connection():
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        os.makedirs(os.path.dirname(PAGE_CACHE_PATH) or ".", exist_ok=True)
+        connection = sqlite3.connect(PAGE_CACHE_PATH, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                endpoint TEXT NOT NULL,
+                wallet TEXT NOT NULL,
+                params TEXT NOT NULL,
+                cursor TEXT NOT NULL,
+                body TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (endpoint, wallet, params, cursor)
+            )
+            """
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS pages_expires_at ON pages (expires_at)")
+        _local.connection = connection
+    return connection
+
+
+def _key(endpoint, wallet_address, params):
+    params = dict(params or {})
+    cursor = params.pop("cursor", None) or ""
+    return endpoint, wallet_address.lower(), json.dumps(params, sort_keys=True), cursor
+
+
+def ttl_for(endpoint, params):
+    """
+    Return how many seconds a response for this request stays fresh.
+    """
+    if endpoint not in PAGINATED_ENDPOINTS:
+        return SNAPSHOT_TTL
+    if (params or {}).get("cursor"):
+        return HISTORICAL_PAGE_TTL
+    return HEAD_PAGE_TTL
+
+
+def get(endpoint, wallet_address, params, allow_stale=False):
+    """
+    Return the cached response for a request, or None if it is missing or expired.
+    Responses expired less than STALE_TTL seconds ago are returned when allow_stale is
+    set, for use while Moralis is unavailable.
+    """
+    if not PAGE_CACHE_PATH:
+        return None
+    try:
+        row = _connection().execute(
+            "SELECT body, expires_at FROM pages WHERE endpoint = ? AND wallet = ? AND params = ? AND cursor = ?",
+            _key(endpoint, wallet_address, params),
+        ).fetchone()
+    except sqlite3.Error as e:
+        print(f"Error reading page cache: {e}")
+        return None
+    if row is None:
+        return None
+    expired_for = time.time() - row[1]
+    if expired_for > 0 and (not allow_stale or expired_for > STALE_TTL):
+        return None
+    return json.loads(row[0])
+
+
+def put(endpoint, wallet_address, params, body):
+    """
+    Store a response with the TTL for its endpoint type, pruning the cache if it has not
+    been pruned for PRUNE_INTERVAL seconds.
+    """
+    if not PAGE_CACHE_PATH:
+        return
+    expires_at = time.time() + ttl_for(endpoint, params)
+    try:
+        connection = _connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                (*_key(endpoint, wallet_address, params), json.dumps(body), expires_at),
+            )
+    except sqlite3.Error as e:
+        print(f"Error writing page cache: {e}")
+        return
+    _prune_if_due()
+
+
+def _prune_if_due():
+    global _pruned_at
+    now = time.time()
+    with _prune_lock:
+        if now - _pruned_at < PRUNE_INTERVAL:
+            return
+        _pruned_at = now
+    try:
+        prune_expired()
+    except sqlite3.Error as e:
+        print(f"Error pruning page cache: {e}")
+
+
+def prune_expired():
+    """
+    Delete every response that expired more than STALE_TTL seconds ago and return how
+    many were removed.
+    """
+    if not PAGE_CACHE_PATH:
+        return 0
+    connection = _connection()
+    with connection:
+        return connection.execute("DELETE FROM pages WHERE expires_at < ?", (time.time() - STALE_TTL,)).rowcount
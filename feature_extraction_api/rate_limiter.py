@@ -0,0 +1,176 @@
+"""
+Compute-unit rate scheduling for Moralis calls.
+
+Moralis bills every request in compute units (CU) that depend on the endpoint and
+throttles plans that exceed their CU-per-second allowance. Every network call made by
+the process takes its endpoint's cost from one token bucket first; when the bucket is
+empty the call is queued until enough units have refilled. Queued calls are served by
+priority lane (see lanes.py), so interactive lookups go ahead of bulk extractions. A
+429 halves the rate (and honours Retry-After); each successful call adds a little back,
+up to the configured plan rate (AIMD).
+"""
+import asyncio
+import os
+import threading
+import time
+
+from lanes import ASYNC_POLL_INTERVAL, DEFAULT_LANE, FairQueue
+
+# Plan throughput in compute units per second, and the burst allowed above it
+MORALIS_CU_PER_SECOND = float(os.environ.get("MORALIS_CU_PER_SECOND", 1000))
+MORALIS_CU_BURST = float(os.environ.get("MORALIS_CU_BURST", MORALIS_CU_PER_SECOND))
+
+# Compute units charged per call, from the Moralis pricing table
+ENDPOINT_COSTS = {
+    "wallet_history": 150,
+    "wallet_transactions_verbose": 10,
+    "defi_positions_summary": 50,
+    "wallet_net_worth": 100,
+    "wallet_swaps": 50,
+}
+DEFAULT_ENDPOINT_COST = 50
+
+# AIMD tuning: the rate never drops below this share of the plan rate, and recovers by
+# this many CU/s per successful call
+MIN_RATE_FRACTION = 0.05
+RATE_RECOVERY_STEP = MORALIS_CU_PER_SECOND * 0.01
+
+
+class ComputeUnitScheduler:
+    """
+    Token bucket shared by every Moralis fetcher in the process.
+    """
+
+    def __init__(self, rate=MORALIS_CU_PER_SECOND, burst=MORALIS_CU_BURST, costs=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.costs = costs if costs is not None else ENDPOINT_COSTS
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.throttled = 0
+        self.queue = FairQueue()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _attempt(self, waiter, start, max_wait):
+        """
+        Try to serve a queued call. Must be called with the lock held.
+
+        Returns:
+            tuple: (True, seconds waited, or None if the call is refused) once the call
+            is decided, or (False, seconds to wait before trying again, or None to wait
+            until woken).
+        """
+        now = time.monotonic()
+        self._refill(now)
+        remaining = start + max_wait - now if max_wait is not None else None
+        if self.queue.head() is not waiter:
+            # Woken when the calls ahead are served
+            if remaining is not None and remaining <= 0:
+                return True, None
+            return False, remaining
+        needed = min(waiter.cost + self.queue.reserve(self.burst), self.burst)
+        wait = max((needed - self.tokens) / self.rate, self.paused_until - now, 0.0)
+        if not wait:
+            self.queue.serve(waiter)
+            self.tokens -= waiter.cost
+            return True, now - start
+        if remaining is not None and wait > remaining:
+            return True, None
+        return False, wait
+
+    def acquire(self, endpoint, max_wait=None, lane=DEFAULT_LANE):
+        """
+        Take the endpoint's cost from the bucket, waiting until it is available.
+
+        Waiting calls are served in fair-queue order across lanes and in arrival order
+        within a lane, and leave the floors of idle lanes in the bucket.
+
+        Args:
+            endpoint (str): Endpoint being called, which determines the cost.
+            max_wait (float, optional): Longest acceptable wait in seconds. If the call
+                would have to wait longer, nothing is taken and None is returned.
+            lane (str): Priority lane of the call.
+
+        Returns:
+            float | None: Seconds spent waiting, or None if the call was refused.
+        """
+        cost = min(self.costs.get(endpoint, DEFAULT_ENDPOINT_COST), self.burst)
+        start = time.monotonic()
+        with self._cond:
+            waiter = self.queue.join(lane, cost)
+            try:
+                while True:
+                    decided, value = self._attempt(waiter, start, max_wait)
+                    if decided:
+                        return value
+                    self._cond.wait(value)
+            finally:
+                self.queue.leave(waiter)
+                # The head may have changed
+                self._cond.notify_all()
+
+    async def acquire_async(self, endpoint, max_wait=None, lane=DEFAULT_LANE):
+        """
+        Awaitable version of acquire for the async Moralis client. The call waits with
+        asyncio.sleep instead of blocking its thread, checking its place in the queue
+        at least every ASYNC_POLL_INTERVAL seconds.
+        """
+        cost = min(self.costs.get(endpoint, DEFAULT_ENDPOINT_COST), self.burst)
+        start = time.monotonic()
+        with self._cond:
+            waiter = self.queue.join(lane, cost)
+        try:
+            while True:
+                with self._cond:
+                    decided, value = self._attempt(waiter, start, max_wait)
+                if decided:
+                    return value
+                await asyncio.sleep(ASYNC_POLL_INTERVAL if value is None else min(value, ASYNC_POLL_INTERVAL))
+        finally:
+            with self._cond:
+                self.queue.leave(waiter)
+                self._cond.notify_all()
+
+    def on_success(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + RATE_RECOVERY_STEP)
+
+    def on_throttled(self, retry_after=None):
+        """
+        Back off after a 429: halve the rate and, if the server said how long to wait,
+        hold every queued call until then.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.throttled += 1
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+    def stats(self):
+        with self._lock:
+            return {"rate": self.rate, "throttled": self.throttled, "queued": self.queue.depth(),
+                    "served": dict(self.queue.served)}
+
+
+def parse_retry_after(value):
+    """
+    Return the Retry-After header in seconds, or None if it is missing or not a number.
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+scheduler = ComputeUnitScheduler()
@@ -0,0 +1,256 @@
+"""
+Request handling shared by the Flask app (main.py) and the ASGI app (asgi.py).
+
+Validation of request bodies, the feature cache lookups and the assembly of response
+entries live here, independent of the web framework, so both serving modes keep the
+same /extract-features contract.
+"""
+import math
+import re
+import time
+
+import metrics
+from circuit_breaker import CircuitOpen, raise_if_open
+from feature_cache import empty_wallet_cache, feature_cache
+from features_extraction import (
+    ALL_FEATURES, FEATURE_MAX_PAGES, FEATURE_MAX_SECONDS, required_endpoints, resolve_features,
+)
+from lanes import resolve_lane
+from moralis_client import FetchBudget
+
+ADDRESS_PATTERN = re.compile(r"^0x[0-9a-fA-F]{40}$")
+INVALID_ADDRESS_ERROR = "walletAddress must be a 0x-prefixed 40 hex character address"
+INVALID_LIMITS_ERROR = "maxPages, maxSeconds and deadlineSeconds must be positive numbers"
+
+def normalize_address(wallet_address):
+    return wallet_address.strip().lower()
+
+def is_valid_address(wallet_address):
+    """
+    Check the address syntax locally so junk input never reaches Moralis.
+    """
+    return isinstance(wallet_address, str) and ADDRESS_PATTERN.match(wallet_address.strip()) is not None
+
+def positive(value, convert):
+    """
+    Convert a requested limit, which must be a finite number above zero.
+
+    Raises:
+        ValueError: If it is not.
+    """
+    value = convert(value)
+    if not math.isfinite(value) or value <= 0:
+        raise ValueError(f"limit must be a positive number, got {value}")
+    return value
+
+def capped(requested, ceiling, convert):
+    """
+    Convert a requested limit, keeping it within the server's ceiling. A missing or null
+    limit gets the ceiling itself; None means unbounded.
+    """
+    if requested is None:
+        return ceiling
+    requested = positive(requested, convert)
+    return requested if ceiling is None else min(requested, ceiling)
+
+def parse_budget_limits(data, headers):
+    """
+    Read the fetch budget limits for a request. maxPages / maxSeconds in the body can
+    only lower FEATURE_MAX_PAGES / FEATURE_MAX_SECONDS, so a client cannot lift the
+    server's caps. The request deadline comes from deadlineSeconds in the body or the
+    X-Deadline-Seconds header.
+
+    Returns:
+        tuple: (max_pages, max_seconds, deadline_seconds), any of which may be None for unbounded.
+
+    Raises:
+        ValueError: If a limit is not a positive number.
+    """
+    deadline_seconds = data.get("deadlineSeconds", headers.get("X-Deadline-Seconds"))
+    return (
+        capped(data.get("maxPages"), FEATURE_MAX_PAGES, int),
+        capped(data.get("maxSeconds"), FEATURE_MAX_SECONDS, float),
+        positive(deadline_seconds, float) if deadline_seconds is not None else None,
+    )
+
+def parse_lane(data, headers, default):
+    """
+    Read the priority lane for a request from priority in the body or the X-Priority
+    header, defaulting to the endpoint's lane.
+
+    Raises:
+        ValueError: If the lane is unknown.
+    """
+    return resolve_lane(data.get("priority", headers.get("X-Priority")), default)
+
+def parse_features(data):
+    """
+    Read the optional list of requested feature and group names.
+
+    Returns:
+        list | None: Requested feature names in output order, or None for every feature.
+
+    Raises:
+        ValueError: If the list is malformed or names an unknown feature.
+    """
+    requested = data.get("features")
+    if requested is None:
+        return None
+    if not isinstance(requested, list) or not all(isinstance(name, str) for name in requested):
+        raise ValueError("features must be a list of feature or group names")
+    features = resolve_features(requested)
+    return None if features == ALL_FEATURES else features
+
+def select_features(result, features):
+    """
+    Narrow a cached full result down to the requested features.
+    """
+    if features is None:
+        return result
+    return {**result, "features": {name: value for name, value in result["features"].items() if name in features}}
+
+def cache_key(address, features):
+    return address if features is None else f"{address}|{','.join(features)}"
+
+def extraction_key(wallet_address, budget_limits, features=None):
+    """
+    Key under which concurrent extractions of the same wallet, features and budget are coalesced.
+    """
+    return f"{cache_key(normalize_address(wallet_address), features)}|{'|'.join(map(str, budget_limits))}"
+
+def add_incomplete_flags(response, wallet_data, features=None):
+    """
+    Mark whether every requested feature was computed from fully fetched data, and flag
+    the features computed from truncated or failed fetches or estimated otherwise.
+    """
+    incomplete = wallet_data.incomplete_features(features)
+    response["complete"] = not any(incomplete.values())
+    if incomplete["truncated"]:
+        response["truncatedFeatures"] = incomplete["truncated"]
+    if incomplete["estimated"]:
+        response["estimatedFeatures"] = incomplete["estimated"]
+    if incomplete["failed"]:
+        response["failedFeatures"] = incomplete["failed"]
+    return response
+
+def split_pending(response, wallet_data, features=None):
+    """
+    If the request deadline passed, move the features that were not completed in time
+    out of the response into pendingFeatures.
+    """
+    if not wallet_data.budget.deadline_exceeded():
+        return response
+    pending = {name for names in wallet_data.incomplete_features(features).values() for name in names}
+    response["deadlineExceeded"] = True
+    response["features"] = {name: value for name, value in response["features"].items() if name not in pending}
+    response["pendingFeatures"] = sorted(pending)
+    return response
+
+def wants_refresh(data, headers):
+    """
+    Whether the client asked to bypass the feature cache, with "refresh": true in the
+    body or a Cache-Control: no-cache header.
+    """
+    if data.get("refresh") is True:
+        return True
+    return "no-cache" in headers.get("Cache-Control", "").lower()
+
+def cached_response(wallet_address, refresh=False, features=None):
+    """
+    Return the cached response entry for a wallet, or None if it has to be computed.
+
+    A complete result computed within the cache TTL, or the empty result of a wallet
+    confirmed to have no history, is returned unless refresh is set. While the circuit
+    breaker of a Moralis endpoint the requested features need up front (see
+    required_endpoints) is open, an expired cached result is served marked stale, or
+    CircuitOpen is raised, instead of tying up a worker on a degraded service.
+    """
+    address = normalize_address(wallet_address)
+    # A cached full result also answers any subset of the features
+    if not refresh:
+        cached = (empty_wallet_cache.get(address) or feature_cache.get(address)
+                  or (features and feature_cache.get(cache_key(address, features))))
+        metrics.cache_lookups.inc("results", "hit" if cached else "miss")
+        if cached:
+            result, age = cached
+            return {**select_features(result, features), "walletAddress": wallet_address, "cached": True,
+                    "cacheAgeSeconds": round(age, 1)}
+
+    try:
+        raise_if_open(required_endpoints(resolve_features(features)))
+    except CircuitOpen:
+        stale = None if refresh else feature_cache.get(address, max_age=feature_cache.retention)
+        if stale is None:
+            raise
+        metrics.cache_lookups.inc("results", "stale")
+        result, age = stale
+        return {**select_features(result, features), "walletAddress": wallet_address, "cached": True,
+                "cacheAgeSeconds": round(age, 1), "stale": True}
+    return None
+
+def finish_response(wallet_address, wallet_data, feature_values, features=None):
+    """
+    Build a wallet's response from its computed features, flag what is incomplete and
+    cache it if it is complete.
+    """
+    # Build a JSON response that includes the wallet address and the features
+    response = {
+        "walletAddress": wallet_address,
+        "features": feature_values
+    }
+    budget = wallet_data.budget
+    metrics.extraction_seconds.observe(time.monotonic() - budget.started, budget.lane)
+    metrics.extraction_pages.observe(budget.pages, budget.lane)
+    add_incomplete_flags(response, wallet_data, features)
+    split_pending(response, wallet_data, features)
+    if wallet_data.budget.stale:
+        response["stale"] = True
+    # Wallets with no history go to the negative cache; results cut short by the budget,
+    # by failed fetches or built from stale pages are not cached, so the next request
+    # can complete them
+    if response["complete"] and not wallet_data.budget.stale:
+        address = normalize_address(wallet_address)
+        if features is None and wallet_data.confirmed_empty():
+            empty_wallet_cache.put(address, response)
+        else:
+            feature_cache.put(cache_key(address, features), response)
+    return response
+
+def parse_wallet_request(data, headers, default_lane):
+    """
+    Validate a single-wallet request body.
+
+    Returns:
+        tuple: ((wallet_address, budget_limits, features, lane, refresh), None) on success,
+        or (None, error message) for a 400 response.
+    """
+    if not data or "walletAddress" not in data:
+        return None, "Missing walletAddress in request body"
+
+    wallet_address = data["walletAddress"]
+    if not is_valid_address(wallet_address):
+        return None, INVALID_ADDRESS_ERROR
+    try:
+        budget_limits = parse_budget_limits(data, headers)
+    except (TypeError, ValueError):
+        return None, INVALID_LIMITS_ERROR
+    try:
+        features = parse_features(data)
+        lane = parse_lane(data, headers, default_lane)
+    except ValueError as e:
+        return None, str(e)
+    return (wallet_address, budget_limits, features, lane, wants_refresh(data, headers)), None
+
+def queued_budget(budget_limits, lane, queued_at):
+    """
+    Create the FetchBudget for an extraction that waited for a slot since queued_at. The
+    paging time limit starts now, while the time spent queued counts against the
+    request deadline.
+    """
+    max_pages, max_seconds, deadline_seconds = budget_limits
+    queued_seconds = time.monotonic() - queued_at
+    metrics.extraction_queue_seconds.observe(queued_seconds, lane)
+    if deadline_seconds is not None:
+        deadline_seconds = max(deadline_seconds - queued_seconds, 0.001)
+    return FetchBudget(max_pages, max_seconds, deadline_seconds, lane)
+
@@ -0,0 +1,194 @@
+"""
+Single-flight coalescing of concurrent work on the same key.
+
+Concurrent callers asking for the same key (a normalized wallet address) wait on one
+in-flight computation and share its result instead of each paging through Moralis.
+Within a process this uses an in-memory table of in-flight calls. Across worker
+processes it uses a shared lock directory: the leader holds an exclusive file lock
+while computing and publishes its result next to the lock, so workers that were
+blocked on the lock pick the result up instead of recomputing it.
+
+Nothing in the lock directory outlives its use: the holder of a lock file removes it
+when it lets go, and published results are deleted once they are
+SINGLE_FLIGHT_RESULT_TTL seconds old, which leaves followers plenty of time to read
+them. Waiting, for a call in this process or for the lock of another, gives up at the
+caller's timeout (the request deadline), after which the caller computes the result
+itself.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: coalesce within the process only
+    fcntl = None
+
+# Set SINGLE_FLIGHT_DIR to an empty string to coalesce within each process only
+SINGLE_FLIGHT_DIR = os.environ.get(
+    "SINGLE_FLIGHT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "inflight"),
+)
+# Seconds a published result is kept for processes that were waiting on its lock
+SINGLE_FLIGHT_RESULT_TTL = float(os.environ.get("SINGLE_FLIGHT_RESULT_TTL", 60))
+# Seconds between attempts to take a lock held by another process
+LOCK_POLL_INTERVAL = 0.05
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Run fn once per key at a time, sharing the result with every concurrent caller.
+    """
+
+    def __init__(self, lock_dir=SINGLE_FLIGHT_DIR):
+        self.lock_dir = lock_dir if fcntl is not None else ""
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    def do(self, key, fn, timeout=None):
+        """
+        Return fn(), or the result of an identical call already in flight.
+
+        Args:
+            key (str): Identity of the computation.
+            fn (callable): Computation to run; its result must be JSON serializable
+                when cross-process coalescing is enabled.
+            timeout (float): Seconds to wait for another caller or process computing the
+                same key before computing it here anyway (forever if None).
+
+        Returns:
+            tuple: (result, shared) where shared is True if another caller computed it.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            if not call.done.wait(timeout):
+                # Past the deadline: don't wait any longer for the leader
+                return fn(), False
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result, shared = self._run_across_processes(key, fn, timeout)
+            return call.result, shared
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _run_across_processes(self, key, fn, timeout):
+        if not self.lock_dir:
+            return fn(), False
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self._prune_results()
+        name = hashlib.sha1(key.encode()).hexdigest()
+        lock_path = os.path.join(self.lock_dir, name + ".lock")
+        result_path = os.path.join(self.lock_dir, name + ".json")
+        waiting_since = time.time()
+
+        lock_file = _lock(lock_path, timeout)
+        if lock_file is None:
+            # Past the deadline: don't wait any longer for the other process
+            return fn(), False
+        try:
+            # A result published after we started waiting came from a computation that
+            # was in flight when we arrived, so it can be shared
+            try:
+                if os.path.getmtime(result_path) >= waiting_since:
+                    with open(result_path) as result_file:
+                        return json.load(result_file), True
+            except (OSError, ValueError):
+                pass
+
+            result = fn()
+            temp_path = f"{result_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as result_file:
+                json.dump(result, result_file)
+            os.replace(temp_path, result_path)
+            return result, False
+        finally:
+            _unlock(lock_path, lock_file)
+
+    def _prune_results(self):
+        """
+        Delete results published more than SINGLE_FLIGHT_RESULT_TTL seconds ago, at most
+        once per TTL in this process.
+        """
+        now = time.time()
+        with self._lock:
+            if now - self._pruned_at < SINGLE_FLIGHT_RESULT_TTL:
+                return
+            self._pruned_at = now
+        try:
+            names = os.listdir(self.lock_dir)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith(".lock"):
+                continue
+            path = os.path.join(self.lock_dir, name)
+            try:
+                if now - os.path.getmtime(path) > SINGLE_FLIGHT_RESULT_TTL:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def _lock(lock_path, timeout):
+    """
+    Take the exclusive lock at lock_path, waiting up to timeout seconds (forever if None).
+
+    The file is removed by whoever releases it, so after taking a lock we check that the
+    path still names the file we locked; if not, the lock was released and removed while
+    we waited, and we start over on the current file.
+
+    Returns:
+        file: The open, locked file, or None if the timeout passed first.
+    """
+    give_up_at = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        lock_file = open(lock_path, "a")
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if give_up_at is not None and time.monotonic() >= give_up_at:
+                    lock_file.close()
+                    return None
+                time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+
+def _unlock(lock_path, lock_file):
+    try:
+        os.remove(lock_path)
+    except OSError:
+        pass
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
@@ -0,0 +1,8 @@
+import os
+
+# The API refuses to start without a Moralis key; the tests never call Moralis
+os.environ.setdefault("API_KEY", "test")
+# Keep the on-disk stores out of the tests unless a test points them somewhere itself
+os.environ.setdefault("PAGE_CACHE_PATH", "")
+os.environ.setdefault("HISTORY_STORE_PATH", "")
+os.environ.setdefault("SINGLE_FLIGHT_DIR", "")
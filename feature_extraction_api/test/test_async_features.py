@@ -0,0 +1,87 @@
+import asyncio
+import os
+import sqlite3
+import sys
+from datetime import datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+pytest.importorskip("httpx")
+
+import async_features  # noqa: E402
+import history_sync  # noqa: E402
+from moralis_client import FetchBudget  # noqa: E402
+
+WALLET = "0x" + "c" * 40
+
+
+def transactions(count):
+    for index in range(count):
+        yield {"hash": f"h{index}", "value": "1000000000000000000", "block_timestamp": "2024-01-01T00:00:00.000Z"}
+
+
+def use_store(monkeypatch, sync_wallet_history):
+    monkeypatch.setattr(history_sync, "HISTORY_STORE_PATH", "store")
+    monkeypatch.setattr(async_features, "sync_wallet_history", sync_wallet_history)
+    paged = []
+
+    async def iter_items(endpoint, wallet_address, params, budget=None):
+        paged.append(endpoint)
+        for tx in transactions(357):
+            yield tx
+
+    monkeypatch.setattr(async_features, "iter_items", iter_items)
+    return paged
+
+
+def test_store_failing_mid_stream_is_not_paged_again(monkeypatch):
+    def failing_stream():
+        yield from transactions(200)
+        raise sqlite3.OperationalError("disk I/O error")
+
+    async def sync_wallet_history(wallet_address, budget=None):
+        return failing_stream()
+
+    paged = use_store(monkeypatch, sync_wallet_history)
+    data = async_features.AsyncWalletData(WALLET, FetchBudget())
+    with pytest.raises(sqlite3.OperationalError):
+        asyncio.run(async_features.load_transaction_history(data))
+    assert paged == []
+
+
+def test_store_failing_to_sync_falls_back_to_moralis(monkeypatch):
+    async def sync_wallet_history(wallet_address, budget=None):
+        raise sqlite3.OperationalError("database is locked")
+
+    paged = use_store(monkeypatch, sync_wallet_history)
+    data = async_features.AsyncWalletData(WALLET, FetchBudget())
+    engine = asyncio.run(async_features.load_transaction_history(data))
+    assert paged == ["wallet_history"]
+    assert engine.transaction_count == 357
+
+
+def test_creation_date_does_not_wait_for_the_history(monkeypatch):
+    created = datetime(2021, 5, 1, tzinfo=timezone.utc)
+
+    async def slow_history(data):
+        await asyncio.sleep(5)
+
+    async def run_walk(walk, wallet_address, budget=None, blocking=False):
+        walk.close()
+        return created
+
+    monkeypatch.setitem(async_features.ASYNC_WALLET_DATA_SOURCES, "transaction_history", slow_history)
+    monkeypatch.setattr(async_features, "run_walk", run_walk)
+
+    async def creation_date():
+        data = async_features.AsyncWalletData(WALLET, FetchBudget())
+        try:
+            data.prefetch("transaction_history")
+            await asyncio.wait_for(data.load("creation_date"), 1)
+            return data.creation_date
+        finally:
+            data.close()
+
+    assert asyncio.run(creation_date()) == created
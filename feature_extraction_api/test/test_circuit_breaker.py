@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from circuit_breaker import CLOSED, HALF_OPEN, CircuitBreaker, CircuitOpen  # noqa: E402
+
+
+def half_open_breaker(endpoint="wallet_history"):
+    breaker = CircuitBreaker(endpoint, min_calls=1, open_seconds=0)
+    breaker.before_call()
+    breaker.record(False)
+    return breaker
+
+
+def test_check_does_not_claim_the_probe():
+    breaker = half_open_breaker()
+    breaker.check()
+    breaker.check()
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+
+def test_release_lets_the_next_call_probe():
+    breaker = half_open_breaker()
+    breaker.before_call()
+    breaker.release()
+    breaker.before_call()
+    breaker.record(True)
+    assert breaker.state == CLOSED
+
+
+def test_refused_budget_does_not_wedge_a_half_open_breaker(monkeypatch):
+    pytest.importorskip("requests")
+    import circuit_breaker
+    import moralis_client
+
+    class Response:
+        status_code = 200
+        headers = {}
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"result": []}
+
+    class Session:
+        def get(self, url, params=None, timeout=None):
+            return Response()
+
+    breaker = half_open_breaker()
+    monkeypatch.setitem(circuit_breaker._breakers, "wallet_history", breaker)
+    monkeypatch.setattr(moralis_client, "get_session", lambda: Session())
+    wallet = "0x" + "a" * 40
+
+    with pytest.raises(moralis_client.BudgetExhausted):
+        moralis_client.moralis_get("wallet_history", wallet, use_cache=False,
+                                   budget=moralis_client.FetchBudget(max_pages=0))
+    assert moralis_client.moralis_get("wallet_history", wallet, use_cache=False) == {"result": []}
+    assert breaker.state == CLOSED
+
+
+def test_raise_if_open_only_checks_the_given_endpoints(monkeypatch):
+    import circuit_breaker
+
+    breaker = CircuitBreaker("wallet_swaps", min_calls=1, open_seconds=60)
+    breaker.before_call()
+    breaker.record(False)
+    monkeypatch.setattr(circuit_breaker, "_breakers", {"wallet_swaps": breaker})
+
+    circuit_breaker.raise_if_open({"wallet_history"})
+    with pytest.raises(CircuitOpen):
+        circuit_breaker.raise_if_open({"wallet_history", "wallet_swaps"})
+    with pytest.raises(CircuitOpen):
+        circuit_breaker.raise_if_open()
@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+pytest.importorskip("flask")
+pytest.importorskip("requests")
+
+import features_extraction  # noqa: E402
+import metrics  # noqa: E402
+import main  # noqa: E402
+
+WALLET = "0x" + "b" * 40
+
+# A wallet with a little history and no DeFi positions, served without Moralis
+SOURCES = {
+    "transaction_history": lambda data: data.engine.consume_history(iter([
+        {"hash": "h1", "value": "1000000000000000000", "block_timestamp": "2024-01-01T00:00:00.000Z"},
+    ])),
+    "verbose_transactions": lambda data: data.engine.consume_verbose(iter(())),
+    "defi_positions": lambda data: [],
+    "creation_date": lambda data: None,
+    "net_worth": lambda data: 0.0,
+    "token_swap_count": lambda data: 0,
+    "oldest_lending_interaction": lambda data: None,
+}
+
+
+def read_events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_events_complete_for_a_wallet_without_defi_positions(monkeypatch):
+    for name, load in SOURCES.items():
+        monkeypatch.setitem(features_extraction.WALLET_DATA_SOURCES, name, load)
+
+    response = main.app.test_client().get(f"/extract-features/events?walletAddress={WALLET}&refresh=true")
+    events = read_events(response.get_data(as_text=True))
+
+    kind, complete = events[-1]
+    assert kind == "complete", complete
+    assert "AverageAPY" not in complete["features"]
+    streamed = {}
+    for kind, event in events[:-1]:
+        assert kind == "group"
+        streamed.update(event["features"])
+    assert streamed == complete["features"]
+
+
+def test_streamed_request_is_counted_once(monkeypatch):
+    for name, load in SOURCES.items():
+        monkeypatch.setitem(features_extraction.WALLET_DATA_SOURCES, name, load)
+    route = "/extract-features/events"
+    in_flight = metrics.http_requests_in_flight._values.get((route,), 0)
+    observations = metrics.http_request_seconds._values.get((route,), [0])[:-1]
+
+    response = main.app.test_client().get(f"{route}?walletAddress={WALLET}&refresh=true")
+    response.get_data()
+    response.close()
+
+    assert metrics.http_requests_in_flight._values.get((route,), 0) == in_flight
+    assert sum(metrics.http_request_seconds._values[(route,)][:-1]) == sum(observations) + 1
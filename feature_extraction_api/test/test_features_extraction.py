@@ -0,0 +1,121 @@
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+pytest.importorskip("requests")
+
+import features_extraction  # noqa: E402
+from features_extraction import WALLET_DATA_SOURCES, WalletData  # noqa: E402
+from test_pipelines_match import WALLET as PIPELINE_WALLET, fake_moralis, use_history_store  # noqa: E402,F401
+
+WALLET = "0x" + "f" * 40
+CREATED = datetime(2021, 5, 1, tzinfo=timezone.utc)
+
+
+def test_creation_date_does_not_wait_for_the_history(monkeypatch):
+    release = threading.Event()
+
+    def slow_history(data):
+        release.wait(5)
+        return data.engine
+
+    monkeypatch.setitem(WALLET_DATA_SOURCES, "transaction_history", slow_history)
+    monkeypatch.setattr(features_extraction, "fetch_wallet_creation_date", lambda wallet, budget=None: CREATED)
+    data = WalletData(WALLET)
+    try:
+        data.prefetch("transaction_history")
+        started = time.monotonic()
+        assert data.creation_date == CREATED
+        assert time.monotonic() - started < 1
+    finally:
+        release.set()
+        data.close()
+
+
+def test_creation_date_reuses_a_finished_history(monkeypatch):
+    history = [{"hash": "h1", "value": "0", "block_timestamp": "2020-03-04T00:00:00.000Z"}]
+    monkeypatch.setitem(
+        WALLET_DATA_SOURCES, "transaction_history", lambda data: data.engine.consume_history(iter(history))
+    )
+
+    def no_lookup(wallet, budget=None):
+        raise AssertionError("the finished history already holds the first transaction")
+
+    monkeypatch.setattr(features_extraction, "fetch_wallet_creation_date", no_lookup)
+    data = WalletData(WALLET)
+    try:
+        data.get("transaction_history")
+        assert data.creation_date == datetime(2020, 3, 4, tzinfo=timezone.utc)
+    finally:
+        data.close()
+
+
+def test_concurrent_bundle_matches_a_sequential_one(fake_moralis, monkeypatch):
+    use_history_store(monkeypatch, "")
+
+    def extract(max_workers):
+        data = WalletData(PIPELINE_WALLET, max_workers=max_workers)
+        try:
+            return features_extraction.calculate_all_features(PIPELINE_WALLET, data)
+        finally:
+            data.close()
+
+    sequential = extract(1)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(extract(features_extraction.FETCH_CONCURRENCY)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [sequential] * 8
+
+
+def test_bundle_runs_at_most_max_workers_fetches_at_once(monkeypatch):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def fetch(data):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+
+    for name in WALLET_DATA_SOURCES:
+        monkeypatch.setitem(WALLET_DATA_SOURCES, name, fetch)
+    data = WalletData(WALLET, max_workers=2)
+    try:
+        data.prefetch(*WALLET_DATA_SOURCES)
+        for name in WALLET_DATA_SOURCES:
+            data.get(name)
+    finally:
+        data.close()
+    assert max(peak) == 2
+
+
+def test_close_drops_fetches_that_have_not_started(monkeypatch):
+    release = threading.Event()
+    started = []
+
+    def fetch(data):
+        started.append(1)
+        release.wait(5)
+
+    monkeypatch.setitem(WALLET_DATA_SOURCES, "net_worth", fetch)
+    monkeypatch.setitem(WALLET_DATA_SOURCES, "token_swap_count", fetch)
+    data = WalletData(WALLET, max_workers=1)
+    data.prefetch("net_worth", "token_swap_count")
+    data.close()
+    release.set()
+    data.get("net_worth")
+    time.sleep(0.05)
+    assert len(started) == 1
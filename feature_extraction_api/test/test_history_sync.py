@@ -0,0 +1,73 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+pytest.importorskip("requests")
+
+import history_sync  # noqa: E402
+import moralis_client  # noqa: E402
+from moralis_client import FetchBudget  # noqa: E402
+
+WALLET = "0x" + "d" * 40
+PAGE = 10
+
+
+def make_history(count, newest_block=1000):
+    return [{"hash": f"h{newest_block - i}", "block_number": str(newest_block - i)} for i in range(count)]
+
+
+class FakeMoralis:
+    """Pages a wallet history newest first, honouring to_block and the budget's page limit."""
+
+    def __init__(self, history):
+        self.history = history
+        self.calls = 0
+
+    def __call__(self, endpoint, wallet_address, params=None, budget=None, count_page=True):
+        if budget is not None:
+            budget.take_page(endpoint)
+        self.calls += 1
+        items = [tx for tx in self.history
+                 if params.get("to_block") is None or int(tx["block_number"]) <= params["to_block"]]
+        start = int(params.get("cursor") or 0)
+        more = start + PAGE < len(items)
+        return {"result": items[start:start + PAGE], "cursor": str(start + PAGE) if more else None}
+
+
+@pytest.fixture
+def moralis(tmp_path, monkeypatch):
+    monkeypatch.setattr(history_sync, "HISTORY_STORE_PATH", str(tmp_path / "history.sqlite3"))
+    monkeypatch.setattr(history_sync, "_local", threading.local())
+    fake = FakeMoralis(make_history(95))
+    monkeypatch.setattr(moralis_client, "moralis_get", fake)
+    return fake
+
+
+def sync(pages=None):
+    return [tx["hash"] for tx in history_sync.sync_wallet_history(WALLET, FetchBudget(max_pages=pages))]
+
+
+def test_truncated_sync_is_kept_and_backfilled(moralis):
+    assert len(sync(pages=3)) == 30
+    assert history_sync.get_backfill(WALLET) is not None
+
+    # Later syncs continue below the stored transactions instead of paging from the head
+    while history_sync.get_backfill(WALLET) is not None:
+        moralis.calls = 0
+        sync(pages=3)
+        assert moralis.calls <= 3
+    assert sync() == [tx["hash"] for tx in moralis.history]
+
+
+def test_new_activity_above_a_backfilled_gap(moralis):
+    sync()
+    moralis.history = make_history(25, newest_block=1100) + moralis.history
+
+    sync(pages=2)
+    assert history_sync.get_backfill(WALLET) is not None
+    assert sync() == [tx["hash"] for tx in moralis.history]
+    assert history_sync.get_backfill(WALLET) is None
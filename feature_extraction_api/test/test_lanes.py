@@ -0,0 +1,93 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lanes import BACKGROUND, BATCH, INTERACTIVE, LaneExecutor, SlotPool  # noqa: E402
+
+WEIGHTS = {INTERACTIVE: 6, BATCH: 3, BACKGROUND: 1}
+FLOORS = {INTERACTIVE: 0.2, BATCH: 0.1, BACKGROUND: 0.05}
+
+
+def wait_until(condition, timeout=5):
+    give_up_at = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < give_up_at, "timed out"
+        time.sleep(0.005)
+
+
+def test_contended_slot_is_shared_by_lane_weight():
+    pool = SlotPool(1, WEIGHTS, FLOORS)
+    assert pool.acquire(BATCH, timeout=0)
+    order = []
+
+    def take(lane):
+        assert pool.acquire(lane, timeout=5)
+        order.append(lane)
+        pool.release(lane)
+
+    threads = [threading.Thread(target=take, args=(lane,)) for lane in (BACKGROUND, BATCH, INTERACTIVE) for _ in range(15)]
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: sum(pool.stats()["queued"].values()) == 45)
+    pool.release(BATCH)
+    for thread in threads:
+        thread.join()
+
+    # Every lane stays backlogged for the first 20 slots, which go 6:3:1
+    first = order[:20]
+    assert [first.count(lane) for lane in (INTERACTIVE, BATCH, BACKGROUND)] == [12, 6, 2]
+    assert len(order) == 45
+
+
+def test_busy_lane_leaves_the_floors_of_idle_lanes():
+    pool = SlotPool(10, WEIGHTS, FLOORS)
+    taken = 0
+    while pool.acquire(BACKGROUND, timeout=0):
+        taken += 1
+    # 2 slots held back for interactive and 1 for batch
+    assert taken == 7
+    assert pool.acquire(INTERACTIVE, timeout=0)
+    assert pool.acquire(BATCH, timeout=0)
+
+
+def test_backlogged_lane_can_use_every_slot_when_the_others_are_idle():
+    pool = SlotPool(1, WEIGHTS, {INTERACTIVE: 0.5, BATCH: 0.5, BACKGROUND: 0.0})
+    assert pool.acquire(BACKGROUND, timeout=0)
+
+
+def test_timed_out_waiter_leaves_the_queue():
+    pool = SlotPool(1, WEIGHTS, FLOORS)
+    assert pool.acquire(BATCH, timeout=0)
+    started = time.monotonic()
+    assert not pool.acquire(INTERACTIVE, timeout=0.05)
+    assert time.monotonic() - started >= 0.05
+    assert pool.stats()["queued"] == {INTERACTIVE: 0, BATCH: 0, BACKGROUND: 0}
+    assert pool.stats()["inUse"][INTERACTIVE] == 0
+
+    # A waiter that gave up at the head of the queue does not hold up the lane behind it
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool.acquire(BACKGROUND, timeout=5)))
+    waiter.start()
+    wait_until(lambda: pool.stats()["queued"][BACKGROUND] == 1)
+    assert not pool.acquire(INTERACTIVE, timeout=0.05)
+    pool.release(BATCH)
+    waiter.join()
+    assert acquired == [True]
+    assert pool.stats()["inUse"] == {INTERACTIVE: 0, BATCH: 0, BACKGROUND: 1}
+
+
+def test_lane_backlog_does_not_hold_the_threads_of_another_lane():
+    executor = LaneExecutor(1)
+    release = threading.Event()
+    blocked = executor.submit(BACKGROUND, release.wait, 5)
+    queued = executor.submit(BACKGROUND, lambda: "later")
+    try:
+        assert executor.submit(INTERACTIVE, lambda lane: lane, INTERACTIVE).result(timeout=1) == INTERACTIVE
+        assert not queued.done()
+    finally:
+        release.set()
+    assert blocked.result(timeout=5)
+    assert queued.result(timeout=5) == "later"
@@ -0,0 +1,59 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from method_classifier import (  # noqa: E402
+    NO_CATEGORIES,
+    WALLET_METHODS_HISTORY,
+    WALLET_METHODS_LIQUIDATE,
+    WALLET_METHODS_REPAY,
+    classify_decoded_call,
+    classify_label,
+)
+
+
+def reference_categories(decoded_call):
+    """The per-transaction checks the classifier replaces, kept verbatim."""
+    liquidate = repay = history = False
+    if isinstance(decoded_call, dict):
+        method = decoded_call.get("label", "").lower()
+        liquidate = any(liquidation_method in method for liquidation_method in WALLET_METHODS_LIQUIDATE)
+        repay = any(method in wm for wm in WALLET_METHODS_REPAY)
+    if decoded_call:
+        method = decoded_call.get("label", "").lower()
+        history = method in WALLET_METHODS_HISTORY
+    return liquidate, repay, history
+
+
+def sample_labels():
+    labels = {"", "transfer", "approve", "multicall", "Repay", "REPAY", "pay", "debt", "ebt",
+              "liquidateBorrowAllowed", "biteTheBullet", "seizeCollateral", "flashloan", "swapExact"}
+    for method in WALLET_METHODS_REPAY + WALLET_METHODS_LIQUIDATE + WALLET_METHODS_HISTORY:
+        labels.update({method, method.lower(), method.upper(), method[:4], method[2:], "x" + method})
+    return sorted(labels)
+
+
+def test_matches_reference_semantics_for_every_label():
+    for label in sample_labels():
+        decoded_call = {"label": label}
+        assert tuple(classify_decoded_call(decoded_call)) == reference_categories(decoded_call), label
+
+
+def test_missing_or_undecoded_calls():
+    assert classify_decoded_call(None) == NO_CATEGORIES
+    assert classify_decoded_call("0xa9059cbb") == NO_CATEGORIES
+    # An empty decoded call has an empty label, which is a substring of every repay method
+    assert tuple(classify_decoded_call({})) == reference_categories({}) == (False, True, False)
+
+
+def test_pinned_examples():
+    assert classify_label("liquidateBorrow").liquidate
+    assert classify_label("Seize").liquidate
+    assert classify_label("repay") == (False, True, True)
+    assert classify_label("repayBorrow").repay  # "repayborrow" is listed in lowercase
+    # Lowercased labels never match mixed-case entries
+    assert classify_label("repayWithPermit") == NO_CATEGORIES
+    assert not classify_label("flashLoan").history
+    assert classify_label("deposit") == (False, False, True)
+    assert classify_label("transfer") == NO_CATEGORIES
@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import page_cache  # noqa: E402
+
+
+def use_cache(tmp_path, monkeypatch, **settings):
+    monkeypatch.setattr(page_cache, "PAGE_CACHE_PATH", str(tmp_path / "pages.sqlite3"))
+    monkeypatch.setattr(page_cache, "_local", page_cache.threading.local())
+    monkeypatch.setattr(page_cache, "_pruned_at", 0.0)
+    for name, value in settings.items():
+        monkeypatch.setattr(page_cache, name, value)
+
+
+def test_expired_pages_are_served_stale_until_their_stale_window_ends(tmp_path, monkeypatch):
+    use_cache(tmp_path, monkeypatch, SNAPSHOT_TTL=-10, STALE_TTL=60)
+    page_cache.put("defi_positions_summary", "0xABC", {}, ["position"])
+    assert page_cache.get("defi_positions_summary", "0xabc", {}) is None
+    assert page_cache.get("defi_positions_summary", "0xabc", {}, allow_stale=True) == ["position"]
+
+    monkeypatch.setattr(page_cache, "STALE_TTL", 5)
+    assert page_cache.get("defi_positions_summary", "0xabc", {}, allow_stale=True) is None
+
+
+def test_put_prunes_pages_past_their_stale_window(tmp_path, monkeypatch):
+    use_cache(tmp_path, monkeypatch, SNAPSHOT_TTL=-10, STALE_TTL=5, PRUNE_INTERVAL=3600)
+    monkeypatch.setattr(page_cache, "_pruned_at", time.time())
+    page_cache.put("defi_positions_summary", "0xold", {}, ["old"])
+    page_cache.put("defi_positions_summary", "0xnew", {}, ["new"])
+    # Both puts are within the interval of the last prune
+    assert page_cache._connection().execute("SELECT COUNT(*) FROM pages").fetchone()[0] == 2
+
+    monkeypatch.setattr(page_cache, "_pruned_at", time.time() - 3601)
+    page_cache.put("wallet_history", "0xkept", {"cursor": "next"}, {"result": []})
+    rows = page_cache._connection().execute("SELECT wallet FROM pages ORDER BY wallet").fetchall()
+    assert rows == [("0xkept",)]
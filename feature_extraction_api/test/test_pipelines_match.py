@@ -0,0 +1,156 @@
+import asyncio
+import os
+import re
+import sys
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+httpx = pytest.importorskip("httpx")
+
+import async_features  # noqa: E402
+import async_moralis_client  # noqa: E402
+import features_extraction  # noqa: E402
+import history_sync  # noqa: E402
+import moralis_client  # noqa: E402
+from moralis_client import ENDPOINTS, FetchBudget  # noqa: E402
+from rate_limiter import scheduler  # noqa: E402
+
+WALLET = "0x" + "e" * 40
+PAGE = 10
+LABELS = ["repay", "liquidationCall", "deposit", "borrow", "swap", "transfer", "supply"]
+
+
+def timestamp(index):
+    return (datetime(2024, 1, 1) - timedelta(days=7 * index)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+HISTORY = [
+    {"hash": f"h{i}", "block_number": str(1000 - i), "value": str((i % 7) * 10 ** 17), "block_timestamp": timestamp(i)}
+    for i in range(45)
+]
+VERBOSE = [
+    {"hash": f"v{i}", "block_timestamp": timestamp(i), "decoded_call": {"label": LABELS[i % len(LABELS)]}}
+    for i in range(32)
+]
+SWAPS = [{"transactionType": ["buy", "sell", "addLiquidity"][i % 3]} for i in range(23)]
+POSITIONS = [
+    {"protocol_name": "aave", "account_data": {"health_factor": 1.5, "net_apy": 2.0},
+     "position": {"balance_usd": 100.0, "position_details": {
+         "is_debt": True, "is_enabled_as_collateral": True, "projected_earnings_usd": {"yearly": 3}}}},
+    {"protocol_name": "uniswap", "account_data": {},
+     "position": {"balance_usd": 50.0, "position_details": {"is_enabled_as_collateral": True, "liquidity": 3}}},
+]
+ROUTES = [
+    (re.compile("^" + re.escape(path).replace(re.escape("{address}"), "(0x[0-9a-fA-F]{40})") + "$"), endpoint)
+    for endpoint, path in ENDPOINTS.items()
+]
+
+
+def paginate(items, params):
+    start = int(params.get("cursor") or 0)
+    more = start + PAGE < len(items)
+    return {"result": items[start:start + PAGE], "cursor": str(start + PAGE) if more else None}
+
+
+def moralis_body(path, params):
+    """Answer a Moralis request path the way the API would for the fake wallet."""
+    endpoint = next(endpoint for pattern, endpoint in ROUTES if pattern.match(path))
+    ascending = params.get("order") == "ASC"
+    if endpoint == "wallet_history":
+        items = HISTORY[::-1] if ascending else HISTORY
+        if params.get("to_block") is not None:
+            items = [tx for tx in items if int(tx["block_number"]) <= int(params["to_block"])]
+        return paginate(items, params)
+    if endpoint == "wallet_transactions_verbose":
+        return paginate(VERBOSE[::-1] if ascending else VERBOSE, params)
+    if endpoint == "wallet_swaps":
+        return paginate(SWAPS, params)
+    if endpoint == "defi_positions_summary":
+        return POSITIONS
+    return {"total_networth_usd": "1234.5"}
+
+
+class Response:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, body):
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.body
+
+
+class Session:
+    def get(self, url, params=None, timeout=None):
+        return Response(moralis_body(url[len(moralis_client.MORALIS_BASE_URL):], params))
+
+
+def handle(request):
+    path = request.url.path[len(httpx.URL(moralis_client.MORALIS_BASE_URL).path):]
+    return httpx.Response(200, json=moralis_body(path, dict(request.url.params)))
+
+
+@pytest.fixture
+def fake_moralis(monkeypatch):
+    for name in ("rate", "max_rate", "burst", "tokens"):
+        monkeypatch.setattr(scheduler, name, 1e9)
+    monkeypatch.setattr(moralis_client, "get_session", lambda: Session())
+    monkeypatch.setattr(async_moralis_client, "_client", None)
+    monkeypatch.setattr(
+        async_moralis_client, "get_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(handle))
+    )
+
+
+def use_history_store(monkeypatch, path):
+    monkeypatch.setattr(history_sync, "HISTORY_STORE_PATH", path)
+    monkeypatch.setattr(history_sync, "_local", threading.local())
+
+
+def run_sync(features, max_pages):
+    budget = FetchBudget(max_pages=max_pages)
+    data = features_extraction.WalletData(WALLET, budget=budget)
+    try:
+        return features_extraction.calculate_all_features(WALLET, data, features), budget
+    finally:
+        data.close()
+
+
+def run_async(features, max_pages):
+    budget = FetchBudget(max_pages=max_pages)
+
+    async def extract():
+        data = async_features.AsyncWalletData(WALLET, budget)
+        try:
+            return await async_features.calculate_all_features(WALLET, data, features)
+        finally:
+            data.close()
+
+    return asyncio.run(extract()), budget
+
+
+def outcome(result):
+    features, budget = result
+    return features, budget.pages, budget.truncated, budget.skipped, budget.failed
+
+
+# Every feature, and a page limit on the history alone (the sources fetched together
+# share the limit in whatever order they reach it)
+@pytest.mark.parametrize("features, max_pages", [(None, None), (["TransactionHistory"], 2)])
+@pytest.mark.parametrize("history_store", [False, True])
+def test_sync_and_async_pipelines_match(fake_moralis, monkeypatch, tmp_path, features, max_pages, history_store):
+    use_history_store(monkeypatch, str(tmp_path / "sync.sqlite3") if history_store else "")
+    sync_first = outcome(run_sync(features, max_pages))
+    sync_again = outcome(run_sync(features, max_pages))
+
+    use_history_store(monkeypatch, str(tmp_path / "async.sqlite3") if history_store else "")
+    assert outcome(run_async(features, max_pages)) == sync_first
+    # A second run continues from the stored history (and its backfill) the same way
+    assert outcome(run_async(features, max_pages)) == sync_again
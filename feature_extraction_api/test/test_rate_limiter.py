@@ -0,0 +1,94 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import rate_limiter  # noqa: E402
+from lanes import BACKGROUND, BATCH, INTERACTIVE, FairQueue  # noqa: E402
+from rate_limiter import ComputeUnitScheduler  # noqa: E402
+
+COSTS = {"cheap": 10, "dear": 50}
+
+
+def make_scheduler(rate=100.0, burst=100.0, floors=None):
+    scheduler = ComputeUnitScheduler(rate, burst, COSTS)
+    scheduler.queue = FairQueue(floors=floors or dict.fromkeys((INTERACTIVE, BATCH, BACKGROUND), 0.0))
+    return scheduler
+
+
+def test_throttling_halves_the_rate_down_to_the_minimum():
+    scheduler = make_scheduler()
+    scheduler.on_throttled()
+    assert scheduler.rate == 50
+    scheduler.on_throttled()
+    assert scheduler.rate == 25
+    for _ in range(10):
+        scheduler.on_throttled()
+    assert scheduler.rate == 100 * rate_limiter.MIN_RATE_FRACTION
+    assert scheduler.throttled == 12
+
+
+def test_successes_recover_the_rate_additively_up_to_the_plan_rate(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "RATE_RECOVERY_STEP", 10.0)
+    scheduler = make_scheduler()
+    scheduler.on_throttled()
+    scheduler.on_throttled()
+    rates = []
+    for _ in range(10):
+        scheduler.on_success()
+        rates.append(scheduler.rate)
+    assert rates == [35, 45, 55, 65, 75, 85, 95, 100, 100, 100]
+
+
+def test_retry_after_holds_calls_until_it_passes():
+    scheduler = make_scheduler()
+    scheduler.on_throttled(retry_after=0.2)
+    assert scheduler.acquire("cheap", max_wait=0.05) is None
+    waited = scheduler.acquire("cheap", max_wait=1)
+    assert 0.1 <= waited < 1
+
+
+def test_refused_call_takes_nothing_and_leaves_the_queue():
+    scheduler = make_scheduler(rate=1.0)
+    scheduler.tokens = 20.0
+    assert scheduler.acquire("dear", max_wait=0) is None
+    assert scheduler.tokens == pytest.approx(20.0, abs=0.1)
+    assert scheduler.stats()["queued"] == {INTERACTIVE: 0, BATCH: 0, BACKGROUND: 0}
+    # The call behind it is not held up by the one that gave up
+    assert scheduler.acquire("cheap", max_wait=0) == pytest.approx(0.0, abs=0.01)
+
+
+def test_bucket_keeps_the_floor_of_an_idle_lane():
+    scheduler = make_scheduler(rate=1.0, floors={INTERACTIVE: 0.3, BATCH: 0.0, BACKGROUND: 0.0})
+    scheduler.tokens = 60.0
+    # 50 for the call plus 30 held back for interactive lookups is more than the bucket has
+    assert scheduler.acquire("dear", max_wait=0, lane=BACKGROUND) is None
+    assert scheduler.acquire("dear", max_wait=0, lane=INTERACTIVE) is not None
+
+
+def test_contended_bucket_is_shared_by_lane_weight():
+    scheduler = make_scheduler(rate=1000.0, burst=10.0)
+    scheduler.tokens = 0.0
+    scheduler.paused_until = time.monotonic() + 0.5
+    order = []
+
+    def call(lane):
+        assert scheduler.acquire("cheap", max_wait=10, lane=lane) is not None
+        order.append(lane)
+
+    threads = [threading.Thread(target=call, args=(lane,)) for lane in (BACKGROUND, BATCH, INTERACTIVE) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    # Every call is queued before the pause ends
+    while sum(scheduler.stats()["queued"].values()) < 30:
+        assert time.monotonic() < scheduler.paused_until
+        time.sleep(0.005)
+    for thread in threads:
+        thread.join()
+
+    first = order[:10]
+    assert [first.count(lane) for lane in (INTERACTIVE, BATCH, BACKGROUND)] == [6, 3, 1]
@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+pytest.importorskip("requests")
+
+import service  # noqa: E402
+from lanes import INTERACTIVE  # noqa: E402
+from service import INVALID_LIMITS_ERROR, parse_budget_limits, parse_wallet_request, queued_budget  # noqa: E402
+
+WALLET = "0x" + "a" * 40
+
+
+@pytest.mark.parametrize("limit", ["deadlineSeconds", "maxSeconds", "maxPages"])
+@pytest.mark.parametrize("value", [0, -1, "nan", "inf", "-inf"])
+def test_non_positive_or_non_finite_limits_are_rejected(limit, value):
+    parsed, error = parse_wallet_request({"walletAddress": WALLET, limit: value}, {}, INTERACTIVE)
+    assert parsed is None
+    assert error == INVALID_LIMITS_ERROR
+
+
+def test_deadline_header_is_validated_too():
+    with pytest.raises(ValueError):
+        parse_budget_limits({}, {"X-Deadline-Seconds": "0"})
+
+
+def test_short_deadline_still_bounds_the_budget(monkeypatch):
+    monkeypatch.setattr(service, "FEATURE_MAX_SECONDS", None)
+    budget_limits = parse_budget_limits({"deadlineSeconds": 0.001}, {})
+    budget = queued_budget(budget_limits, INTERACTIVE, queued_at=0)
+    assert budget.request_deadline is not None
+    time.sleep(0.01)
+    assert budget.exhausted()
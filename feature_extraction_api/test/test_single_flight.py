@@ -0,0 +1,68 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import single_flight  # noqa: E402
+from single_flight import SingleFlight  # noqa: E402
+
+fcntl = pytest.importorskip("fcntl")
+
+
+def test_lock_file_is_removed_and_old_results_pruned(tmp_path, monkeypatch):
+    coalescer = SingleFlight(str(tmp_path))
+    assert coalescer.do("wallet-a", lambda: {"a": 1}) == ({"a": 1}, False)
+    assert sorted(os.listdir(tmp_path)) == [hashlib.sha1(b"wallet-a").hexdigest() + ".json"]
+
+    monkeypatch.setattr(single_flight, "SINGLE_FLIGHT_RESULT_TTL", 0)
+    time.sleep(0.01)
+    coalescer.do("wallet-b", lambda: {"b": 1})
+    assert sorted(os.listdir(tmp_path)) == [hashlib.sha1(b"wallet-b").hexdigest() + ".json"]
+
+
+def test_waiting_for_another_process_gives_up_at_the_timeout(tmp_path):
+    name = hashlib.sha1(b"wallet").hexdigest()
+    with open(os.path.join(tmp_path, name + ".lock"), "a") as held:
+        # Another open file description stands in for another process holding the lock
+        fcntl.flock(held, fcntl.LOCK_EX)
+        started = time.monotonic()
+        assert SingleFlight(str(tmp_path)).do("wallet", lambda: "mine", timeout=0.2) == ("mine", False)
+        assert 0.2 <= time.monotonic() - started < 1
+
+
+def test_waiter_shares_the_result_published_while_it_waited(tmp_path):
+    name = hashlib.sha1(b"wallet").hexdigest()
+    lock_path = os.path.join(tmp_path, name + ".lock")
+    held = open(lock_path, "a")
+    fcntl.flock(held, fcntl.LOCK_EX)
+
+    def release_after_publishing():
+        time.sleep(0.1)
+        with open(os.path.join(tmp_path, name + ".json"), "w") as result_file:
+            result_file.write('"theirs"')
+        single_flight._unlock(lock_path, held)
+
+    threading.Thread(target=release_after_publishing).start()
+    assert SingleFlight(str(tmp_path)).do("wallet", lambda: "mine", timeout=5) == ("theirs", True)
+    assert not os.path.exists(lock_path)
+
+
+def test_waiting_for_a_caller_in_this_process_gives_up_at_the_timeout():
+    coalescer = SingleFlight("")
+    release = threading.Event()
+    leader = threading.Thread(target=coalescer.do, args=("wallet", lambda: release.wait(5)))
+    leader.start()
+    try:
+        while "wallet" not in coalescer._calls:
+            time.sleep(0.005)
+        started = time.monotonic()
+        assert coalescer.do("wallet", lambda: "mine", timeout=0.2) == ("mine", False)
+        assert 0.2 <= time.monotonic() - started < 1
+    finally:
+        release.set()
+        leader.join()